@@ -1,5 +1,4 @@
 import os
-import cv2
 import threading
 from kivy.app import App
 from kivy.uix.label import Label
@@ -9,8 +8,8 @@ from kivy.uix.textinput import TextInput
 from kivy.uix.scrollview import ScrollView
 from kivy.clock import Clock
 from kivy.uix.popup import Popup
-from extract import extract_frames  # Import your existing extract_frames function
-from ssim import process_all_images_in_directory  # Import the SSIM processing logic
+from metrics import format_progress
+from gaps import format_ranges, range_count
 
 EXTRACTED_FRAMES_DIR = 'uploads/extracted_frames'
 os.makedirs(EXTRACTED_FRAMES_DIR, exist_ok=True)
@@ -75,6 +74,7 @@ class VideoProcessorApp(App):
         self.frame_count.text = "Extracting frames..."
         self.process_button.disabled = True
         self.cancel_button.disabled = False
+        self.processing_cancelled = False
 
         # Run the processing in a separate thread
         threading.Thread(target=self.process_video).start()
@@ -85,34 +85,40 @@ class VideoProcessorApp(App):
         self.cancel_button.disabled = True
 
     def process_video(self):
+        # Imported on the first run rather than at startup, so that the Kivy app opens before OpenCV
+        # and NumPy are loaded; recognition then runs in this thread, in the app's own process
+        from extract import DetectionOptions, detect_missing_frames  # Stream frames from the video into SSIM recognition
+        from classifier import DIGIT_MODEL_PATH
+        from checkpoint import CHECKPOINT_DIR
+        from resultlog import result_log_path
+
+        model_path = DIGIT_MODEL_PATH if os.path.exists(DIGIT_MODEL_PATH) else None
         try:
             if not self.video_path:
                 return
 
-            # Extract frames and validate video
-            validate = extract_frames(self.video_path)
+            # Stream frames from the video and find the missing ones
+            options = DetectionOptions(predefined_dir=PREDEFINED_DIGITS_DIR, model_path=model_path, incremental=True, predictive=True,
+                                       checkpoint_dir=CHECKPOINT_DIR, result_log=result_log_path(self.video_path))
+            validate = detect_missing_frames(self.video_path, options, cancel_check=lambda: self.processing_cancelled,
+                                             on_progress=self.report_progress)
             if not validate:
                 self.update_result_text("Frame numbers not found\n", "orange")
                 return
 
-            if self.processing_cancelled:
-                self.update_result_text("Processing cancelled.\n")
-                return
-
-            # Process frames to find missing ones
-            missing_frames = process_all_images_in_directory(EXTRACTED_FRAMES_DIR, PREDEFINED_DIGITS_DIR, use_ssim=True, check_valid_digits_in_frame=False)
+            missing_ranges = validate[1]
 
             # Update frame count
             total_frames_text = f"Total Frames: {validate[0]}"
             Clock.schedule_once(lambda dt: self.update_frame_count(total_frames_text))
 
             if self.processing_cancelled:
-                self.update_result_text("Processing cancelled.\n")
+                self.update_result_text(f"Processing cancelled after {validate[0]} frames, process the video again to resume.\n")
                 return
 
             # Display results
-            if missing_frames:
-                result_text = f"Missing Frames: {missing_frames}\n"
+            if missing_ranges:
+                result_text = f"Missing Frames ({range_count(missing_ranges)}): {format_ranges(missing_ranges)}\n"
                 self.update_result_text(result_text, "red")
             else:
                 self.update_result_text("No Missing Frames!\n", "green")
@@ -124,6 +130,11 @@ class VideoProcessorApp(App):
             # Clock.schedule_once(lambda dt: self.process_button.disabled(False))
             # Clock.schedule_once(lambda dt: self.cancel_button.disabled(True))
 
+    def report_progress(self, progress):
+        # Kivy widgets may only change on the main thread, so the label update is scheduled there
+        text = format_progress(progress)
+        Clock.schedule_once(lambda dt: self.update_frame_count(text))
+
     def update_result_text(self, text, color="black"):
         Clock.schedule_once(lambda dt: setattr(self.result_output, 'text', text))
         Clock.schedule_once(lambda dt: setattr(self.result_output, 'foreground_color', color))
@@ -1,12 +1,12 @@
 import os
-import cv2
 import threading
+import multiprocessing
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import Text
 from tkinter.scrolledtext import ScrolledText
-from extract import extract_frames  # Import the existing extract_frames function
-from ssim import process_all_images_in_directory  # Import the SSIM processing logic
+from metrics import format_progress
+from gaps import format_ranges, range_count
 from tkinterdnd2 import TkinterDnD, DND_FILES  # Import drag and drop support
 
 # Define directories (no need to move the video now)
@@ -16,6 +16,9 @@ os.makedirs(EXTRACTED_FRAMES_DIR, exist_ok=True)
 PREDEFINED_DIGITS_DIR = 'uploads/predefined_digits'
 os.makedirs(PREDEFINED_DIGITS_DIR, exist_ok=True)
 
+# Number of processes used for digit recognition
+RECOGNITION_WORKERS = os.cpu_count()
+
 class VideoProcessorApp:
     def __init__(self, root):
         self.root = root
@@ -102,6 +105,7 @@ class VideoProcessorApp:
             self.process_button.config(state=tk.NORMAL)
 
     def start_processing(self):
+        self.loading_label.config(text="Processing...")
         self.loading_label.pack()  # Show the loading label
         self.process_button.config(state=tk.DISABLED)  # Disable process button during processing
         self.cancel_button.config(state=tk.NORMAL)  # Enable cancel button during processing
@@ -111,39 +115,62 @@ class VideoProcessorApp:
         self.result_text.delete('1.0', tk.END)  # Clear previous result
 
         self.processing_cancelled = False
+        self.missing_so_far = 0
+        self.progress_text = "Processing..."
         self.processing_thread = threading.Thread(target=self.process_video)
         self.processing_thread.start()
 
     def cancel_processing(self):
         self.processing_cancelled = True
 
+    def report_missing(self, start, end):
+        # Called from the processing thread as soon as a gap in the counter appears
+        self.missing_so_far += end - start + 1
+        self.update_loading_label()
+
+    def report_progress(self, progress):
+        # Called from the processing thread a few times per second
+        self.progress_text = format_progress(progress)
+        self.update_loading_label()
+
+    def update_loading_label(self):
+        text = f"{self.progress_text}, {self.missing_so_far} missing frames so far"
+        self.root.after(0, lambda: self.loading_label.config(text=text))
+
     def process_video(self):
+        # The core is only imported here, so that the window comes up without loading OpenCV and
+        # NumPy, and the recognition workers, which import this module again, skip everything else
+        from extract import DetectionOptions, detect_missing_frames  # Stream frames from the video into SSIM recognition
+        from classifier import DIGIT_MODEL_PATH
+        from checkpoint import CHECKPOINT_DIR
+        from resultlog import result_log_path
+
+        # Digits are recognized with the trained classifier when one was saved, with the templates otherwise
+        model_path = DIGIT_MODEL_PATH if os.path.exists(DIGIT_MODEL_PATH) else None
         try:
 
             if self.video_path:
-                validate = extract_frames(self.video_path)
+                options = DetectionOptions(predefined_dir=PREDEFINED_DIGITS_DIR, model_path=model_path, incremental=True, predictive=True,
+                                           workers=RECOGNITION_WORKERS, checkpoint_dir=CHECKPOINT_DIR, result_log=result_log_path(self.video_path))
+                validate = detect_missing_frames(self.video_path, options, cancel_check=lambda: self.processing_cancelled,
+                                                 on_missing=self.report_missing, on_progress=self.report_progress)
                 if not validate:
                     self.result_text.insert(tk.END, "Frame numbers not found\n")
                     self.result_text.config(fg="orange")
                     return
-                
-                
-                if self.processing_cancelled:
-                    self.result_text.insert(tk.END, "Processing cancelled.\n")
-                    return
 
-                missing_frames = process_all_images_in_directory(EXTRACTED_FRAMES_DIR, PREDEFINED_DIGITS_DIR, use_ssim=True, check_valid_digits_in_frame=False)
+                missing_ranges = validate[1]
 
                 self.frame_count.config(state=tk.NORMAL)
                 self.frame_count.insert(tk.END,"Total Frames: "+str(validate[0]))   
                 self.frame_count.config(state=tk.DISABLED)
      
                 if self.processing_cancelled:
-                    self.result_text.insert(tk.END, "Processing cancelled.\n")
+                    self.result_text.insert(tk.END, f"Processing cancelled after {validate[0]} frames, process the video again to resume.\n")
                     return
 
-                if missing_frames:
-                    self.result_text.insert(tk.END, f"Missing Frames: {missing_frames}\n")
+                if missing_ranges:
+                    self.result_text.insert(tk.END, f"Missing Frames ({range_count(missing_ranges)}): {format_ranges(missing_ranges)}\n")
                     self.result_text.config(fg="red")
                 else:
                     self.result_text.insert(tk.END, "No Missing Frames!\n")
@@ -158,6 +185,7 @@ class VideoProcessorApp:
 
 # Start the Tkinter application
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Worker processes of the frozen executable
     root = TkinterDnD.Tk()
     app = VideoProcessorApp(root)
     root.mainloop()
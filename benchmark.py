@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import argparse
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+from metrics import ProcessingMetrics
+from gaps import COUNTER_MODULUS, missing_ranges, expand_ranges
+from ssim import RECOGNITION_CACHE_SIZE, RecognitionOptions, DigitTemplateBank, RecognitionCache, load_recognizer, recognize_frames, recognize_frames_parallel
+from extract import (PREDEFINED_DIGITS_DIR, DECODERS, DEFAULT_DECODER, REGION_OF_INTEREST, ORIENTATION_PROBE_FRAMES, DetectionOptions, locate_counter, crop_rotated_roi,
+                     iter_video_frames, detect_missing_frames)
+
+# Startup budgets, in seconds: a fresh interpreter importing a core module, and a spawned
+# recognition worker answering its first frame
+COLD_START_BUDGET = 1.0
+WORKER_SPAWN_BUDGET = 1.5
+
+# Core modules whose cold import is measured: what the apps and the CLI load to process a
+# video, and what every recognition worker loads
+STARTUP_MODULES = ('extract', 'ssim', 'cli')
+
+# Runs of every startup measurement, the fastest of which counts
+STARTUP_REPEATS = 3
+
+# Frame size and counter region of the --low-resolution case. REGION_OF_INTEREST does not fit
+# in these frames, so the counter has to be found by search_counter
+LOW_RESOLUTION = (320, 180)
+LOW_RESOLUTION_ROI = (10, 10, 100, 20)
+
+# Clockwise rotation in degrees -> the cv2 code that turns an upright frame that way
+RENDER_ROTATIONS = {0: None, 90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+def render_counter_video(video_path, length, drops=(), start=0, resolution=(640, 480), fps=30, rotation=0, predefined_dir=PREDEFINED_DIGITS_DIR, region=REGION_OF_INTEREST, seed=0):
+    """Write a video whose frames show a 5-digit counter in the ROI, drawn from the digit templates.
+
+    The counter runs from start and skips the values in drops, so the video holds length
+    frames and the dropped values are exactly the frames a correct detection reports missing.
+    The background is fixed noise and the whole frame is turned clockwise by rotation degrees.
+    Returns the list of counter values that were written.
+    """
+    x, y, w, h = region
+    digit_width = w // 5
+    glyphs = {digit: cv2.cvtColor(cv2.resize(image, (digit_width, h)), cv2.COLOR_GRAY2BGR)
+              for digit, image in DigitTemplateBank(predefined_dir).images.items()}
+
+    width, height = resolution
+    rotate_code = RENDER_ROTATIONS[rotation]
+    frame_size = (height, width) if rotation in (90, 270) else (width, height)
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, frame_size)
+    if not writer.isOpened():
+        raise RuntimeError(f"Cannot write video file {video_path}")
+
+    background = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    drops = set(drops)
+    written = []
+    number = start
+    try:
+        while len(written) < length:
+            if number in drops:
+                number += 1
+                continue
+            frame = background.copy()
+            for i, digit in enumerate(f'{number % 100000:05d}'):
+                frame[y:y + h, x + i * digit_width:x + (i + 1) * digit_width] = glyphs[digit]
+            if rotate_code is not None:
+                frame = cv2.rotate(frame, rotate_code)
+            writer.write(frame)
+            written.append(number)
+            number += 1
+    finally:
+        writer.release()
+    return written
+
+def random_drops(length, drop_count, start=0, seed=0):
+    """Pick drop_count counter values to drop, never the first one."""
+    return sorted(random.Random(seed).sample(range(start + 1, start + length), drop_count))
+
+def throughput(count, seconds):
+    return round(count / seconds, 1) if seconds > 0 else None
+
+def measure_cold_import(module, repeats=STARTUP_REPEATS):
+    """Seconds a fresh interpreter takes to start and import the module, best of repeats."""
+    best = None
+    for _ in range(repeats):
+        s = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import {module}'], cwd=os.path.dirname(os.path.abspath(__file__)), check=True, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - s
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def measure_worker_spawn(predefined_dir=PREDEFINED_DIGITS_DIR, model_path=None, repeats=STARTUP_REPEATS):
+    """Seconds from starting a pool of one recognition worker to its first recognized frame, best of repeats.
+
+    The worker imports the main module of this process again, as the workers of the apps
+    import theirs, then loads the templates or the model.
+    """
+    roi = np.zeros((REGION_OF_INTEREST[3], REGION_OF_INTEREST[2]), dtype=np.uint8)
+    best = None
+    for _ in range(repeats):
+        s = time.perf_counter()
+        results = recognize_frames_parallel([(0, roi)], RecognitionOptions(predefined_dir, model_path=model_path, workers=1))
+        next(results)
+        elapsed = time.perf_counter() - s
+        results.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def measure_startup(predefined_dir=PREDEFINED_DIGITS_DIR, model_path=None):
+    """Cold import time of every STARTUP_MODULES module and the worker spawn time, in seconds."""
+    return {
+        'cold_import': {module: round(measure_cold_import(module), 4) for module in STARTUP_MODULES},
+        'worker_spawn': round(measure_worker_spawn(predefined_dir, model_path), 4),
+    }
+
+def startup_regressions(startup):
+    """Messages for the startup times over their budget."""
+    regressions = [f"cold import of {module} took {seconds} s, over the {COLD_START_BUDGET} s budget"
+                   for module, seconds in startup['cold_import'].items() if seconds > COLD_START_BUDGET]
+    if startup['worker_spawn'] > WORKER_SPAWN_BUDGET:
+        regressions.append(f"worker spawn took {startup['worker_spawn']} s, over the {WORKER_SPAWN_BUDGET} s budget")
+    return regressions
+
+def benchmark_video(video_path, expected_missing, options=DetectionOptions()):
+    """Time every stage of the detection on the video and check the result against expected_missing.
+
+    Decode, crop/rotate, recognition and gap detection are timed one at a time, so each
+    throughput only counts its own stage; the end-to-end run then goes through
+    detect_missing_frames exactly as the apps call it, and its latency statistics are reported.
+    Calibration profiles are not used, so the counter is located from scratch on every run.
+    """
+    results = {}
+    options = options._replace(profiles_path=None)
+    template_bank = DigitTemplateBank(options.predefined_dir)
+    recognizer, options = load_recognizer(options, template_bank)
+
+    s = time.perf_counter()
+    frame_count = sum(1 for _ in iter_video_frames(video_path))
+    results['decode'] = time.perf_counter() - s
+
+    frames = iter_video_frames(video_path)
+    probe = [frame for _, frame in itertools.islice(frames, ORIENTATION_PROBE_FRAMES)]
+    s = time.perf_counter()
+    rotate_cnt, region, confidence = locate_counter(video_path, probe, template_bank, profiles_path=None)
+    results['orientation'] = time.perf_counter() - s
+    if rotate_cnt is None:
+        frames.close()
+        raise RuntimeError(f"No valid counter found in {video_path} (SSIM: {confidence})")
+
+    rois = []
+    crop_time = 0.0
+    for frame in probe:
+        s = time.perf_counter()
+        rois.append(crop_rotated_roi(frame, region, rotate_cnt))
+        crop_time += time.perf_counter() - s
+    for _, frame in frames:
+        s = time.perf_counter()
+        rois.append(crop_rotated_roi(frame, region, rotate_cnt))
+        crop_time += time.perf_counter() - s
+    results['crop'] = crop_time
+
+    cache = RecognitionCache(RECOGNITION_CACHE_SIZE)
+    s = time.perf_counter()
+    numbers = [number for _, number in recognize_frames(enumerate(rois), options, template_bank=recognizer, cache=cache)]
+    results['recognition'] = time.perf_counter() - s
+
+    frames_found = [int(number) for number in numbers if number is not None]
+    s = time.perf_counter()
+    ranges = missing_ranges(frames_found)
+    results['gap_detection'] = time.perf_counter() - s
+    missing_frames = expand_ranges(ranges)
+
+    metrics = ProcessingMetrics()
+    s = time.perf_counter()
+    detected = detect_missing_frames(video_path, options, template_bank=template_bank, metrics=metrics)
+    results['end_to_end'] = time.perf_counter() - s
+    summary = metrics.summary()
+
+    detected_missing = expand_ranges(detected[1]) if detected else None
+    return {
+        'frames': frame_count,
+        'rotation_detected': rotate_cnt,
+        'region_detected': list(region),
+        'seconds': {stage: round(seconds, 4) for stage, seconds in results.items()},
+        'frames_per_second': {stage: throughput(frame_count, seconds) for stage, seconds in results.items() if stage != 'orientation'},
+        'end_to_end_latency': summary['stages'],
+        'cache_hit_rate': summary['cache_hit_rate'],
+        'unreadable_frames': sum(1 for number in numbers if number is None),
+        'missing_expected': len(expected_missing),
+        'missing_detected': len(missing_frames),
+        'false_missing': sorted(set(missing_frames) - set(expected_missing)),
+        'undetected_missing': sorted(set(expected_missing) - set(missing_frames)),
+        'accurate': missing_frames == expected_missing and detected_missing == expected_missing,
+    }
+
+def print_results(results):
+    print(f"{results['frames']} frames, counter at {tuple(results['region_detected'])}, rotation {results['rotation_detected']}")
+    for stage, seconds in results['seconds'].items():
+        fps = results['frames_per_second'].get(stage)
+        rate = f"{fps:>10} frames/s" if fps is not None else ""
+        print(f"  {stage:<14}{seconds:>9.4f} s {rate}")
+    print("  end-to-end latency per frame (mean / p95 / max, ms):")
+    for stage, stats in results['end_to_end_latency'].items():
+        print(f"    {stage:<12}{stats['mean'] * 1000:>8.3f} {stats['p95'] * 1000:>8.3f} {stats['max'] * 1000:>8.3f}")
+    print(f"  missing: {results['missing_detected']} detected / {results['missing_expected']} expected, "
+          f"{results['unreadable_frames']} unreadable frame(s)")
+    if not results['accurate']:
+        print(f"  INACCURATE: false missing {results['false_missing']}, undetected {results['undetected_missing']}")
+    if 'startup' in results:
+        imports = ', '.join(f"{module} {seconds * 1000:.0f}" for module, seconds in results['startup']['cold_import'].items())
+        print(f"  startup (ms): cold import {imports}; worker spawn {results['startup']['worker_spawn'] * 1000:.0f}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark missing frame detection on a synthetic counter video.")
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--length', type=int, default=300, help="frames in the video (default: 300)")
+    parser.add_argument('--roi', type=int, nargs=4, default=list(REGION_OF_INTEREST), metavar=('X', 'Y', 'W', 'H'), help="region the counter is drawn in, before rotation (default: %(default)s)")
+    parser.add_argument('--low-resolution', action='store_true', help=f"render at {LOW_RESOLUTION[0]}x{LOW_RESOLUTION[1]} with the counter at {LOW_RESOLUTION_ROI} (overrides --width, --height and --roi)")
+    parser.add_argument('--rotation', type=int, default=0, choices=sorted(RENDER_ROTATIONS), help="clockwise rotation of the video in degrees")
+    parser.add_argument('--start', type=int, default=100, help="first counter value (default: 100)")
+    parser.add_argument('--drops', type=int, default=5, help="number of randomly dropped frames (default: 5)")
+    parser.add_argument('--drop', type=int, action='append', default=None, help="counter value to drop; repeat to drop several (overrides --drops)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--predefined-dir', default=PREDEFINED_DIGITS_DIR)
+    parser.add_argument('--mse', action='store_true', help="match digits with MSE instead of SSIM")
+    parser.add_argument('--model', default=None, help="recognize digits with this trained classifier instead of the templates")
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--predictive', action='store_true')
+    parser.add_argument('--decoder', choices=DECODERS, default=DEFAULT_DECODER, help="decoder of the end-to-end run")
+    parser.add_argument('--workers', type=int, default=None, help="recognition processes in the end-to-end run")
+    parser.add_argument('--video', default=None, help="keep the rendered video at this path")
+    parser.add_argument('--json', default=None, help="also write the results to this JSON file")
+    parser.add_argument('--min-fps', type=float, default=None, help="exit with an error if end-to-end frames/s falls below this")
+    parser.add_argument('--no-startup', action='store_true', help="do not measure cold start and worker spawn times against their budgets")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.low_resolution:
+        (args.width, args.height), args.roi = LOW_RESOLUTION, list(LOW_RESOLUTION_ROI)
+    drops = sorted(args.drop) if args.drop else random_drops(args.length, args.drops, args.start, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = args.video or os.path.join(tmp_dir, 'benchmark.mp4')
+        s = time.perf_counter()
+        written = render_counter_video(video_path, args.length, drops, args.start, (args.width, args.height), args.fps, args.rotation, args.predefined_dir, tuple(args.roi), args.seed)
+        print(f"Rendered {len(written)} frames at {args.width}x{args.height} in {time.perf_counter() - s:.2f} s, dropped {drops}")
+        # Only drops within the rendered run are skipped, in counter order as the 5-digit counter shows them after a rollover
+        expected_missing = [number % COUNTER_MODULUS for number in drops if args.start <= number < written[-1]]
+        options = DetectionOptions(predefined_dir=args.predefined_dir, use_ssim=not args.mse, model_path=args.model, incremental=args.incremental,
+                                   predictive=args.predictive, workers=args.workers, decoder=args.decoder)
+        results = benchmark_video(video_path, expected_missing, options)
+
+    if not args.no_startup:
+        results['startup'] = measure_startup(args.predefined_dir, args.model)
+    results['config'] = vars(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if not results['accurate']:
+        return 1
+    end_to_end_fps = results['frames_per_second']['end_to_end']
+    if args.min_fps is not None and end_to_end_fps < args.min_fps:
+        print(f"Regression: end-to-end {end_to_end_fps} frames/s is below {args.min_fps}")
+        return 1
+    regressions = startup_regressions(results['startup']) if 'startup' in results else []
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
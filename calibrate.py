@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import contextlib
+import cv2
+import numpy as np
+from collections import namedtuple
+
+# Saved calibration profiles, keyed by video source
+CALIBRATION_PROFILES_PATH = 'uploads/calibration_profiles.json'
+
+# Seconds a save waits for the profiles lock before taking it to be left by a dead process
+PROFILES_LOCK_TIMEOUT = 5.0
+
+# Digits in the counter overlay
+NUM_DIGITS = 5
+
+# The coarse search scales every frame so that the digits are this many pixels high
+COARSE_DIGIT_HEIGHT = 12
+
+# Smallest digit height searched, as a fraction of the shorter side of the frame
+MIN_DIGIT_HEIGHT_FRACTION = 1 / 40
+
+# Ratio between two consecutive digit heights tried by the coarse search
+SCALE_STEP = 1.2
+
+# Distance between the left edges of two digits, relative to the width of a digit glyph
+DIGIT_PITCHES = (1.0, 1.1, 1.2, 1.35)
+
+# Pixels a digit may be off its place in the row at the coarse scale, where pitches are rounded
+COARSE_TOLERANCE = 1
+
+# Relative digit heights tried around the coarse match at full resolution, and the relative
+# range of pitches tried around the coarse pitch (every whole pixel in between); the two are
+# searched independently, as the coarse scale can miss one and not the other
+REFINE_SCALES = tuple(1 + step / 50 for step in range(-10, 11))
+REFINE_PITCH_RANGE = 0.2
+
+# Where and how the counter was found: region (x, y, w, h) in the frame turned rotate_cnt
+# times counterclockwise, and how well its weakest digit matched
+CounterLocation = namedtuple('CounterLocation', ['region', 'rotate_cnt', 'score'])
+
+def digit_response(image, templates):
+    """Best normalized correlation of any digit template at every position of the image."""
+    responses = [cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED) for template in templates]
+    height = min(response.shape[0] for response in responses)
+    width = min(response.shape[1] for response in responses)
+    response = np.max([response[:height, :width] for response in responses], axis=0)
+    # Flat areas have no defined correlation
+    return np.nan_to_num(response, nan=-1.0, posinf=-1.0, neginf=-1.0)
+
+def best_digit_row(response, pitch):
+    """Position and score of the best row of NUM_DIGITS matches, pitch pixels apart.
+
+    The score of a row is its weakest digit, so every digit of the counter must match.
+    """
+    width = response.shape[1] - (NUM_DIGITS - 1) * pitch
+    if width <= 0:
+        return None, -1.0
+    row = np.min([response[:, k * pitch:k * pitch + width] for k in range(NUM_DIGITS)], axis=0)
+    y, x = np.unravel_index(np.argmax(row), row.shape)
+    return (int(x), int(y)), float(row[y, x])
+
+def resized_templates(images, digit_height):
+    """Digit templates scaled to digit_height, keeping their aspect ratio."""
+    return [cv2.resize(image, (max(int(round(image.shape[1] * digit_height / image.shape[0])), 1), digit_height), interpolation=cv2.INTER_AREA)
+            for image in images]
+
+def search_counter(frame, template_images, rotations=range(4), cancel_check=None):
+    """Search the frame for the counter at any position, scale and quarter-turn orientation.
+
+    Every orientation is searched at digit heights SCALE_STEP apart, on a copy of the frame
+    scaled so that the digits are COARSE_DIGIT_HEIGHT pixels high, which keeps every scale
+    cheap. The best coarse match of each orientation is then refined at full resolution, and
+    the best refined match wins. Returns a CounterLocation, or None if the frame is too small
+    to hold a counter or cancel_check() returned True between two scales.
+    """
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    template_images = list(template_images)
+    coarse_templates = resized_templates(template_images, COARSE_DIGIT_HEIGHT)
+    glyph_width = np.mean([template.shape[1] for template in coarse_templates])
+
+    best = None
+    for rotate_cnt in rotations:
+        upright = np.ascontiguousarray(np.rot90(gray, rotate_cnt))
+        height, width = upright.shape
+        coarse = None
+        digit_height = max(COARSE_DIGIT_HEIGHT, int(min(height, width) * MIN_DIGIT_HEIGHT_FRACTION))
+        while digit_height <= height and digit_height * glyph_width / COARSE_DIGIT_HEIGHT * NUM_DIGITS <= width:
+            if cancel_check is not None and cancel_check():
+                return None
+            factor = COARSE_DIGIT_HEIGHT / digit_height
+            small = cv2.resize(upright, (max(int(width * factor), 1), max(int(height * factor), 1)), interpolation=cv2.INTER_AREA)
+            if small.shape[0] >= COARSE_DIGIT_HEIGHT and small.shape[1] >= glyph_width * NUM_DIGITS:
+                response = digit_response(small, coarse_templates)
+                # Let every digit of the row match within COARSE_TOLERANCE pixels of its place
+                size = 2 * COARSE_TOLERANCE + 1
+                response = cv2.dilate(response, np.ones((size, size), np.uint8))
+                for pitch_ratio in DIGIT_PITCHES:
+                    pitch = int(round(glyph_width * pitch_ratio))
+                    position, score = best_digit_row(response, pitch)
+                    if position is not None and (coarse is None or score > coarse[0]):
+                        coarse = (score, position[0] / factor, position[1] / factor, digit_height, pitch / factor)
+            digit_height = int(round(digit_height * SCALE_STEP))
+
+        if coarse is not None:
+            location = refine_counter(upright, template_images, rotate_cnt, *coarse[1:])
+            if location is not None and (best is None or location.score > best.score):
+                best = location
+    return best
+
+def refine_counter(upright, template_images, rotate_cnt, x, y, digit_height, pitch):
+    """Search scales and pitches close to a coarse match, in a window around it at full resolution."""
+    height, width = upright.shape
+    margin = int(pitch)
+    x0, y0 = max(int(x) - margin, 0), max(int(y) - margin, 0)
+    x1 = min(int(x + NUM_DIGITS * pitch) + 2 * margin, width)
+    y1 = min(int(y + digit_height) + 2 * margin, height)
+    window = upright[y0:y1, x0:x1]
+
+    pitches = range(max(int(pitch * (1 - REFINE_PITCH_RANGE)), 1), int(pitch * (1 + REFINE_PITCH_RANGE)) + 1)
+    best = None
+    for scale in REFINE_SCALES:
+        refined_height = int(round(digit_height * scale))
+        templates = resized_templates(template_images, refined_height)
+        if refined_height > window.shape[0] or max(template.shape[1] for template in templates) > window.shape[1]:
+            continue
+        response = digit_response(window, templates)
+        for refined_pitch in pitches:
+            position, score = best_digit_row(response, refined_pitch)
+            if position is not None and (best is None or score > best.score):
+                region = (x0 + position[0], y0 + position[1], NUM_DIGITS * refined_pitch, refined_height)
+                best = CounterLocation(region, rotate_cnt, score)
+    return best
+
+def video_source_key(video_path):
+    """Key of the calibration profile of a video: its resolution, codec and frame rate.
+
+    Videos recorded by the same device with the same settings share the key, and so the
+    counter location.
+    """
+    cap = cv2.VideoCapture(video_path)
+    try:
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    finally:
+        cap.release()
+    codec = ''.join(chr((fourcc >> 8 * i) & 0xFF) for i in range(4)).strip('\x00 ') or 'unknown'
+    return f"{width}x{height}/{codec}/{fps:.3f}fps"
+
+def load_profiles(path=CALIBRATION_PROFILES_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_profile(key, path=CALIBRATION_PROFILES_PATH):
+    """Return the CounterLocation saved for the source key, or None."""
+    profile = load_profiles(path).get(key)
+    if profile is None:
+        return None
+    return CounterLocation(tuple(profile['region']), profile['rotate_cnt'], profile['score'])
+
+@contextlib.contextmanager
+def profiles_lock(path, timeout=PROFILES_LOCK_TIMEOUT):
+    """Hold the lock file of the profiles, created exclusively, so that one process at a time updates them."""
+    lock_path = f"{path}.lock"
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() < deadline:
+                time.sleep(0.01)
+                continue
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            deadline = time.time() + timeout
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+def save_profile(key, location, path=CALIBRATION_PROFILES_PATH):
+    """Save the location as the profile of the source key, replacing the file atomically.
+
+    The profiles are re-read under profiles_lock, so concurrent jobs merge their profiles
+    instead of overwriting each other's.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with profiles_lock(path):
+        profiles = load_profiles(path)
+        profiles[key] = {'region': [int(value) for value in location.region], 'rotate_cnt': int(location.rotate_cnt), 'score': float(location.score)}
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(profiles, f, indent=2)
+        os.replace(temp_path, path)
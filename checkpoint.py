@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+import numpy as np
+from collections import namedtuple
+
+# Checkpoints of interrupted runs, one file per video
+CHECKPOINT_DIR = 'uploads/checkpoints'
+
+# Seconds of recognition between two checkpoints of a running detection
+CHECKPOINT_INTERVAL = 30.0
+
+# Counter value stored for a frame whose counter could not be read
+UNREADABLE = -1
+
+# State of a detection after its first next_frame frames: numbers holds the counter value of
+# every one of them (UNREADABLE when not read), confidences, timestamps and margins their
+# result log columns (see resultlog.py), and rotate_cnt and region locate the counter
+Checkpoint = namedtuple('Checkpoint', ['identity', 'next_frame', 'numbers', 'rotate_cnt', 'region', 'confidences', 'timestamps', 'margins'])
+
+# Record of one frame in the frames file of a checkpoint
+CHECKPOINT_RECORD = np.dtype([('number', '<i4'), ('confidence', '<f4'), ('timestamp', '<f8'), ('margin', '<f4')])
+
+def video_identity(video_path):
+    """Identify the video file by its absolute path, size and modification time.
+
+    A checkpoint of a file that was replaced or modified since no longer matches.
+    """
+    stat = os.stat(video_path)
+    return f"{os.path.abspath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+def output_name(video_path):
+    """Name of the files written for a video: its name and a hash of its absolute path.
+
+    Videos of the same name in different directories never share a checkpoint, result log,
+    report or frame dump, even when they are processed at the same time.
+    """
+    digest = hashlib.sha1(os.path.abspath(video_path).encode()).hexdigest()[:12]
+    return f"{os.path.basename(video_path)}.{digest}"
+
+def checkpoint_path(video_path, checkpoint_dir=CHECKPOINT_DIR):
+    """Path of the checkpoint of the video, without extension (see output_name).
+
+    A checkpoint is a .json header with the identity of the video and the counter location,
+    and a .frames file of CHECKPOINT_RECORD records, one per frame in frame order.
+    """
+    return os.path.join(checkpoint_dir, output_name(video_path))
+
+def read_header(path):
+    try:
+        with open(path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_checkpoint(video_path, checkpoint, checkpoint_dir=CHECKPOINT_DIR):
+    """Bring the checkpoint of the video on disk up to checkpoint.next_frame frames.
+
+    Only the frames past those already saved are appended, so a save costs the frames
+    recognized since the last one rather than the whole run. The header is replaced
+    atomically, and the saved frames dropped, when the video or the counter location changed.
+    numbers, confidences, timestamps and margins may be any buffers of int32, float32, float64
+    and float32 values, e.g. array('i'), array('f'), array('d') and array('f') that keep
+    growing; only their new tail is read.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = checkpoint_path(video_path, checkpoint_dir)
+    header = {'identity': checkpoint.identity, 'rotate_cnt': int(checkpoint.rotate_cnt), 'region': [int(value) for value in checkpoint.region]}
+    if read_header(path) != header:
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(header, f)
+        open(path + '.frames', 'wb').close()
+        os.replace(temp_path, path + '.json')
+
+    with open(path + '.frames', 'r+b' if os.path.exists(path + '.frames') else 'w+b') as f:
+        # A save cut short leaves a partial record at the end, which is written over
+        saved = min(os.fstat(f.fileno()).st_size // CHECKPOINT_RECORD.itemsize, checkpoint.next_frame)
+        records = np.empty(checkpoint.next_frame - saved, dtype=CHECKPOINT_RECORD)
+        records['number'] = np.frombuffer(checkpoint.numbers, dtype=np.int32)[saved:checkpoint.next_frame]
+        records['confidence'] = np.frombuffer(checkpoint.confidences, dtype=np.float32)[saved:checkpoint.next_frame]
+        records['timestamp'] = np.frombuffer(checkpoint.timestamps, dtype=np.float64)[saved:checkpoint.next_frame]
+        records['margin'] = np.frombuffer(checkpoint.margins, dtype=np.float32)[saved:checkpoint.next_frame]
+        f.seek(saved * CHECKPOINT_RECORD.itemsize)
+        f.write(records.tobytes())
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+def load_checkpoint(video_path, checkpoint_dir=CHECKPOINT_DIR):
+    """Return the Checkpoint saved for the video, or None if there is none or the video changed."""
+    path = checkpoint_path(video_path, checkpoint_dir)
+    header = read_header(path)
+    if header is None:
+        return None
+    try:
+        count = os.path.getsize(path + '.frames') // CHECKPOINT_RECORD.itemsize
+        records = np.fromfile(path + '.frames', dtype=CHECKPOINT_RECORD, count=count)
+        checkpoint = Checkpoint(header['identity'], len(records), records['number'], int(header['rotate_cnt']),
+                                tuple(int(value) for value in header['region']), records['confidence'], records['timestamp'], records['margin'])
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Ignoring unreadable checkpoint {path}: {e}")
+        return None
+    if checkpoint.identity != video_identity(video_path):
+        return None
+    return checkpoint
+
+def remove_checkpoint(video_path, checkpoint_dir=CHECKPOINT_DIR):
+    path = checkpoint_path(video_path, checkpoint_dir)
+    for extension in ('.json', '.frames'):
+        try:
+            os.remove(path + extension)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,116 @@
+import sys
+import argparse
+import cv2
+import numpy as np
+from ssim import PREDEFINED_DIGITS_DIR, load_images_from_directory
+
+# Default location of the trained model
+DIGIT_MODEL_PATH = 'uploads/digit_model.npz'
+
+# Slices are scaled to this (width, height) before classification
+FEATURE_SIZE = (16, 16)
+
+# Augmented copies of every template used for training
+AUGMENTED_SAMPLES = 200
+
+def area_matrix(size, cells):
+    """(cells, size) matrix averaging size samples into cells equal runs, as cv2.INTER_AREA does.
+
+    A sample that straddles two runs counts towards each in proportion to its overlap.
+    """
+    edges = np.arange(cells + 1) * size / cells
+    samples = np.arange(size)
+    overlap = np.minimum(edges[1:, None], samples + 1) - np.maximum(edges[:-1, None], samples)
+    return (np.clip(overlap, 0, None) * cells / size).astype(np.float32)
+
+def slice_features(batch, feature_size=FEATURE_SIZE):
+    """Turn a (n, height, width) batch of slices into unit-length, zero-mean feature rows.
+
+    The slices are area-averaged down to feature_size all at once, by a batched matrix product
+    with area_matrix on either side. Normalizing removes brightness and contrast, so the dot
+    product of two rows is their normalized cross-correlation.
+    """
+    batch = np.asarray(batch, dtype=np.float32)
+    height, width = batch.shape[1:]
+    features = area_matrix(height, feature_size[1]) @ batch @ area_matrix(width, feature_size[0]).T
+    features = features.reshape(len(batch), -1)
+    features -= features.mean(axis=1, keepdims=True)
+    features /= np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-6)
+    return features
+
+def augment(image, rng):
+    """Random variation of a digit image: small shift, scale and rotation, contrast, blur and noise."""
+    height, width = image.shape
+    angle = rng.uniform(-4, 4)
+    scale = rng.uniform(0.85, 1.15)
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, scale)
+    matrix[:, 2] += rng.uniform(-0.08, 0.08, 2) * (width, height)
+    image = cv2.warpAffine(image, matrix, (width, height), borderMode=cv2.BORDER_REPLICATE).astype(np.float32)
+
+    image = image * rng.uniform(0.6, 1.3) + rng.uniform(-40, 40)
+    if rng.random() < 0.5:
+        image = cv2.GaussianBlur(image, (0, 0), rng.uniform(0.5, 1.5))
+    image += rng.normal(0, rng.uniform(0, 10), image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+class DigitClassifier:
+    """Nearest-centroid digit classifier over normalized, downsampled slices.
+
+    Each digit is a single centroid, the mean feature row of its template and augmented
+    copies. Scoring a batch of slices is one matrix multiply with the centroids, and the
+    confidence of a slice is its cosine similarity with the best centroid (1.0 for a perfect
+    match). It has the score_batch() of DigitTemplateBank, so it can be used wherever a
+    template bank recognizes digits; the confidence then takes the place of the SSIM score.
+    """
+
+    def __init__(self, digits, centroids, feature_size=FEATURE_SIZE):
+        self.digits = list(digits)
+        self.centroids = centroids.astype(np.float32)
+        self.feature_size = tuple(feature_size)
+        self.directory = None
+
+    @classmethod
+    def train(cls, predefined_dir=PREDEFINED_DIGITS_DIR, samples=AUGMENTED_SAMPLES, feature_size=FEATURE_SIZE, seed=0):
+        rng = np.random.default_rng(seed)
+        digits, centroids = [], []
+        for digit, image in sorted(load_images_from_directory(predefined_dir).items()):
+            images = [image] + [augment(image, rng) for _ in range(samples)]
+            centroid = slice_features(images, feature_size).mean(axis=0)
+            digits.append(int(digit))
+            centroids.append(centroid / np.linalg.norm(centroid))
+        return cls(digits, np.stack(centroids), feature_size)
+
+    @classmethod
+    def load(cls, path=DIGIT_MODEL_PATH):
+        with np.load(path) as model:
+            return cls(model['digits'].tolist(), model['centroids'], model['feature_size'].tolist())
+
+    def save(self, path=DIGIT_MODEL_PATH):
+        np.savez_compressed(path, digits=np.array(self.digits), centroids=self.centroids, feature_size=np.array(self.feature_size))
+
+    def score_batch(self, batch, use_ssim=True):
+        """Return the best digit of each slice in a (n, height, width) batch, its confidence and its margin.
+
+        The margin is the lead of the confidence over that of the next best centroid. use_ssim
+        is ignored; it is only accepted to match DigitTemplateBank.score_batch.
+        """
+        scores = slice_features(batch, self.feature_size) @ self.centroids.T
+        best = scores.argmax(axis=1)
+        top = np.sort(scores, axis=1).astype(np.float64)
+        return [self.digits[i] for i in best], top[:, -1], top[:, -1] - top[:, -2]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the digit classifier from the digit templates.")
+    parser.add_argument('--predefined-dir', default=PREDEFINED_DIGITS_DIR)
+    parser.add_argument('--output', default=DIGIT_MODEL_PATH, help="model file to write (default: %(default)s)")
+    parser.add_argument('--samples', type=int, default=AUGMENTED_SAMPLES, help="augmented copies per digit")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    classifier = DigitClassifier.train(args.predefined_dir, args.samples, seed=args.seed)
+    classifier.save(args.output)
+    print(f"Saved {len(classifier.digits)} digit centroids of {classifier.centroids.shape[1]} features to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
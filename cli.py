@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from extract import PREDEFINED_DIGITS_DIR, DECODERS, DEFAULT_DECODER, DetectionOptions, detect_missing_frames, detect_missing_frames_sparse
+from metrics import ProcessingMetrics, set_verbose
+from gaps import range_count, format_ranges
+from calibrate import CALIBRATION_PROFILES_PATH
+from checkpoint import CHECKPOINT_DIR, output_name
+from resultlog import ResultLog
+from ssim import BORDERLINE_MARGIN
+from live import STATUS_INTERVAL, monitor_streams
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+# Frames listed by analyze --compare and --margin before the rest are only counted
+COMPARE_LIST_LIMIT = 20
+
+def job_executor(jobs, verbose=False):
+    """Process pool for video jobs; spawned so that jobs never inherit the parent's threads."""
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'), initializer=set_verbose, initargs=(verbose,))
+
+def report_path(video_path, output_dir):
+    """Path of the JSON report written for the video."""
+    return os.path.join(output_dir, output_name(video_path) + '.json')
+
+def result_log_dir(video_path, output_dir):
+    """Directory of the per-frame result log written for the video, next to its report."""
+    return os.path.join(output_dir, output_name(video_path) + '_results')
+
+def process_video_job(video_path, output_dir, options, dump_frames=False):
+    """Detect the missing frames of one video with the DetectionOptions and write its JSON report.
+
+    Every job keeps its state to itself: frames are streamed in memory and, with dump_frames,
+    written to a directory of its own next to the report. A sparse_stride picks the sparse scan.
+    """
+    start = time.time()
+    report = {'video': os.path.abspath(video_path), 'valid': False, 'frame_count': None, 'missing_count': None, 'missing_ranges': None}
+    result_log = result_log_dir(video_path, output_dir)
+    options = options._replace(result_log=result_log)
+    try:
+        if options.sparse_stride:
+            result = detect_missing_frames_sparse(video_path, options)
+        else:
+            if dump_frames:
+                options = options._replace(dump_dir=os.path.join(output_dir, output_name(video_path) + '_frames'))
+            metrics = ProcessingMetrics()
+            result = detect_missing_frames(video_path, options, metrics=metrics)
+            report['metrics'] = metrics.summary()
+        if result:
+            frame_count, missing_ranges = result
+            report.update(valid=True, frame_count=frame_count, missing_count=range_count(missing_ranges), missing_ranges=missing_ranges, result_log=result_log)
+    except Exception as e:
+        report['error'] = f"{type(e).__name__}: {e}"
+    report['elapsed_seconds'] = round(time.time() - start, 3)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(report_path(video_path, output_dir), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+def print_report(report):
+    name = os.path.basename(report['video'])
+    if 'error' in report:
+        print(f"{name}: failed ({report['error']})")
+    elif not report['valid']:
+        print(f"{name}: frame numbers not found")
+    else:
+        borderline_count = report.get('metrics', {}).get('frames_borderline')
+        borderline = f", {borderline_count} borderline" if borderline_count else ''
+        print(f"{name}: {report['frame_count']} frames, {report['missing_count']} missing{borderline} ({report['elapsed_seconds']}s)")
+
+def process_videos(video_paths, output_dir, options, jobs=None, dump_frames=False, verbose=False):
+    """Process the videos in parallel, one job per video, and return their reports."""
+    reports = []
+    with job_executor(jobs, verbose) as executor:
+        futures = [executor.submit(process_video_job, path, output_dir, options, dump_frames) for path in video_paths]
+        for future in as_completed(futures):
+            report = future.result()
+            print_report(report)
+            reports.append(report)
+    return reports
+
+def watch_directory(directory, output_dir, options, jobs=None, interval=5.0, dump_frames=False, verbose=False):
+    """Process every video that appears in the directory, until interrupted.
+
+    A video is picked up once its size is unchanged between two polls, so files that are
+    still being copied are left alone. Videos that already have a report are skipped.
+    """
+    sizes = {}
+    submitted = set()
+    pending = {}
+    print(f"Watching {directory} for videos (Ctrl+C to stop)...")
+    with job_executor(jobs, verbose) as executor:
+        try:
+            while True:
+                for filename in sorted(os.listdir(directory)):
+                    video_path = os.path.join(directory, filename)
+                    if not filename.lower().endswith(VIDEO_EXTENSIONS) or video_path in submitted:
+                        continue
+                    if os.path.exists(report_path(video_path, output_dir)):
+                        submitted.add(video_path)
+                        continue
+
+                    size = os.path.getsize(video_path)
+                    if sizes.get(video_path) == size:
+                        submitted.add(video_path)
+                        pending[executor.submit(process_video_job, video_path, output_dir, options, dump_frames)] = video_path
+                    else:
+                        sizes[video_path] = size
+
+                for future in [future for future in pending if future.done()]:
+                    del pending[future]
+                    print_report(future.result())
+
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("Stopping watcher...")
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def analyze_result_log(path, threshold=None, compare_path=None, margin=None):
+    """Print the gaps of a result log at the confidence threshold, and how it differs from another log.
+
+    The frames read with a digit less than margin ahead of another are listed as borderline;
+    margin defaults to BORDERLINE_MARGIN, except for MSE logs whose margins are in other units.
+    SSIM margins are upper bounds (see DigitTemplateBank.score_batch), so a frame may be less
+    clear-cut than its margin says but never more.
+    """
+    result_log = ResultLog(path)
+    name = os.path.basename(result_log.meta.get('video', path))
+    unreadable_count = len(result_log.unreadable_frames(threshold))
+    if result_log.meta.get('sparse_stride'):
+        # The samples of a sparse scan leave gaps between them, so only the run's own result stands
+        print(f"{name}: {len(result_log)} of {result_log.meta['frame_count']} frames sampled, {unreadable_count} unreadable, "
+              f"{format_ranges(result_log.meta['missing_ranges']) or 'none'} missing at the time of the scan")
+    else:
+        missing_ranges = result_log.missing_ranges(threshold)
+        print(f"{name}: {len(result_log)} frames, {unreadable_count} unreadable, {range_count(missing_ranges)} missing ({format_ranges(missing_ranges) or 'none'})")
+    if margin is None and result_log.meta.get('use_ssim', True):
+        margin = BORDERLINE_MARGIN
+    if margin is not None:
+        borderline = result_log.borderline_frames(margin, threshold)
+        print(f"{len(borderline)} borderline frames (a digit less than {margin} ahead of another)")
+        for frame in borderline[:COMPARE_LIST_LIMIT].tolist():
+            print(f"  frame {frame}")
+    if compare_path is None:
+        return
+    frames, numbers, other_numbers = result_log.compare(ResultLog(compare_path))
+    print(f"{len(frames)} frames read differently in {compare_path}")
+    for frame, number, other_number in zip(frames[:COMPARE_LIST_LIMIT].tolist(), numbers.tolist(), other_numbers.tolist()):
+        print(f"  frame {frame}: {number} vs {other_number}")
+
+def print_drop(event):
+    print(f"{event.source}: dropped {format_ranges([(event.start, event.end)])} before frame {event.frame_index} "
+          f"({event.latency * 1000:.1f} ms after capture)", flush=True)
+
+def print_stream_statuses(statuses, verbose=False):
+    """Warn about the streams whose recognition falls behind; with verbose, report every stream."""
+    for status in statuses:
+        if status['behind'] or verbose:
+            print(f"{status['source']}: {status['state']}, {status['frames_recognized']} frames recognized, "
+                  f"{status['backlog']} waiting{' (falling behind)' if status['behind'] else ''}, {status['drops']} drop(s)", flush=True)
+
+def print_stream_summary(summary):
+    if summary['error']:
+        print(f"{summary['source']}: failed ({summary['error']})")
+        return
+    latency = summary['stages'].get('capture_to_result')
+    text = f"{summary['source']}: {summary['frames_recognized']} of {summary['frames_decoded']} frames recognized, {summary['missing_count']} missing"
+    if latency is not None:
+        text += f", capture to result {latency['mean'] * 1000:.1f} ms mean / {latency['max'] * 1000:.1f} ms max"
+    if summary['capture_waits']:
+        text += f", capture waited on {summary['capture_waits']} frames"
+    print(text)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Detect missing frames in videos with a frame counter overlay, without the GUI.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--output-dir', default='reports', help="directory for the JSON reports (default: reports)")
+    common.add_argument('--jobs', type=int, default=None, help="videos processed at the same time (default: CPU count)")
+    common.add_argument('--predefined-dir', default=PREDEFINED_DIGITS_DIR, help="directory with the digit templates")
+    common.add_argument('--mse', action='store_true', help="match digits with MSE instead of SSIM")
+    common.add_argument('--model', default=None, help="recognize digits with this trained classifier (see classifier.py) instead of the templates")
+    common.add_argument('--workers', type=int, default=None, help="recognition processes per video (default: 1)")
+    common.add_argument('--no-incremental', action='store_true', help="re-score every digit slice of every frame")
+    common.add_argument('--no-predictive', action='store_true', help="do not try the expected next counter values first")
+    common.add_argument('--decoder', choices=DECODERS, default=DEFAULT_DECODER, help="decode full frames with OpenCV, or only the ROI with FFmpeg (default: %(default)s)")
+    common.add_argument('--profiles', default=CALIBRATION_PROFILES_PATH, help="calibration profiles with the counter location of each video source (default: %(default)s)")
+    common.add_argument('--no-profiles', action='store_true', help="locate the counter in every video without reading or saving calibration profiles")
+    common.add_argument('--resume', action='store_true', help=f"checkpoint long videos in {CHECKPOINT_DIR} and resume the ones interrupted there")
+    common.add_argument('--sparse-stride', type=int, default=None, help="sample every N-th frame and bisect only around gaps")
+    common.add_argument('--dump-frames', action='store_true', help="write the cropped frames next to each report")
+    common.add_argument('--verbose', action='store_true', help="print the score of every digit slice")
+
+    process = subparsers.add_parser('process', parents=[common], help="process the given videos and exit")
+    process.add_argument('videos', nargs='+', help="video files to process")
+
+    watch = subparsers.add_parser('watch', parents=[common], help="process videos as they appear in a directory")
+    watch.add_argument('directory', help="directory to watch")
+    watch.add_argument('--interval', type=float, default=5.0, help="seconds between directory polls (default: 5)")
+
+    live = subparsers.add_parser('live', help="watch live sources for dropped frames while they record")
+    live.add_argument('sources', nargs='+', help="capture device indices (0, 1, ...), files, pipes or stream URLs")
+    live.add_argument('--predefined-dir', default=PREDEFINED_DIGITS_DIR, help="directory with the digit templates")
+    live.add_argument('--mse', action='store_true', help="match digits with MSE instead of SSIM")
+    live.add_argument('--model', default=None, help="recognize digits with this trained classifier instead of the templates")
+    live.add_argument('--pace', action='store_true', help="read files no faster than their frame rate, as if they were cameras")
+    live.add_argument('--duration', type=float, default=None, help="stop after this many seconds (default: when every source ends, or Ctrl+C)")
+    live.add_argument('--interval', type=float, default=STATUS_INTERVAL, help="seconds between backlog checks (default: %(default)s)")
+    live.add_argument('--json', default=None, help="write the summary and drop events of every stream to this JSON file")
+    live.add_argument('--verbose', action='store_true', help="report every stream at each backlog check")
+
+    analyze = subparsers.add_parser('analyze', help="re-analyze the per-frame result log written next to a report, without decoding the video")
+    analyze.add_argument('result_log', help="result log directory (<video>.<hash>_results in the output directory)")
+    analyze.add_argument('--threshold', type=float, default=None, help="count frames scored below this SSIM (above this MSE) as unreadable")
+    analyze.add_argument('--compare', default=None, help="list the frames another result log of the same video reads differently")
+    analyze.add_argument('--margin', type=float, default=None, help=f"list the frames with a digit less than this ahead of the next best one (default: {BORDERLINE_MARGIN} for SSIM logs)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'analyze':
+        analyze_result_log(args.result_log, args.threshold, args.compare, args.margin)
+        return 0
+    if args.command == 'live':
+        summaries = monitor_streams(args.sources, args.predefined_dir, use_ssim=not args.mse, model_path=args.model, on_drop=print_drop,
+                                    on_status=lambda statuses: print_stream_statuses(statuses, args.verbose), interval=args.interval,
+                                    pace=args.pace, duration=args.duration)
+        for summary in summaries:
+            print_stream_summary(summary)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(summaries, f, indent=2)
+        return 0 if all(summary['error'] is None for summary in summaries) else 1
+
+    options = DetectionOptions(predefined_dir=args.predefined_dir, use_ssim=not args.mse, model_path=args.model, workers=args.workers,
+                               incremental=not args.no_incremental, predictive=not args.no_predictive, sparse_stride=args.sparse_stride,
+                               decoder=args.decoder, profiles_path=None if args.no_profiles else args.profiles,
+                               checkpoint_dir=CHECKPOINT_DIR if args.resume else None)
+
+    if args.command == 'process':
+        reports = process_videos(args.videos, args.output_dir, options, jobs=args.jobs, dump_frames=args.dump_frames, verbose=args.verbose)
+        return 0 if all(report['valid'] for report in reports) else 1
+
+    watch_directory(args.directory, args.output_dir, options, jobs=args.jobs, interval=args.interval, dump_frames=args.dump_frames, verbose=args.verbose)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
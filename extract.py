@@ -1,6 +1,61 @@
 import cv2
 import os
-from ssim import process_all_images_in_directory
+import re
+import itertools
+import queue
+import threading
+import time
+from array import array
+from collections import namedtuple
+from metrics import ProcessingMetrics, log
+from gaps import COUNTER_MODULUS, GapDetector, missing_ranges_between
+from calibrate import CALIBRATION_PROFILES_PATH, NUM_DIGITS, CounterLocation, search_counter, video_source_key, load_profile, save_profile
+from checkpoint import CHECKPOINT_INTERVAL, UNREADABLE, Checkpoint, video_identity, load_checkpoint, save_checkpoint, remove_checkpoint
+from resultlog import write_result_log, unwrap_numbers
+from ssim import (PREDEFINED_DIGITS_DIR, RECOGNITION_CACHE_SIZE, RecognitionOptions, DigitTemplateBank, RecognitionCache, slice_image, score_digit_slices,
+                  load_recognizer, recognize_frames, recognize_frames_parallel, score_frame)
+
+EXTRACTED_FRAMES_DIR = 'uploads/extracted_frames'
+
+# Default region of interest, tried before searching the frames for the counter
+REGION_OF_INTEREST = (200, 200, 250, 50)
+
+# Pixel offsets of the region edges tried with SSIM around a counter found by the search
+REGION_POLISH_OFFSETS = (-1, 0, 1)
+
+# Number of leading frames scored in every orientation before picking the rotation
+ORIENTATION_PROBE_FRAMES = 3
+
+# cv2.rotate codes for 1, 2 and 3 quarter turns counterclockwise
+ROTATE_CODES = {1: cv2.ROTATE_90_COUNTERCLOCKWISE, 2: cv2.ROTATE_180, 3: cv2.ROTATE_90_CLOCKWISE}
+
+# Decoded ROIs buffered between the decoder thread and recognition
+DECODE_QUEUE_SIZE = 64
+
+# Decoder backends: OpenCV decodes full frames, FFmpeg only the ROI; auto uses FFmpeg when installed
+DECODERS = ('opencv', 'ffmpeg', 'auto')
+DEFAULT_DECODER = 'opencv'
+
+# Default distance between the frames sampled by a sparse scan
+SPARSE_SCAN_STRIDE = 32
+
+# Frames up to this far ahead are reached by decoding forward instead of seeking
+SEEK_DISTANCE = 16
+
+# How a video is processed, on top of the RecognitionOptions: cache_size slices and ROIs kept
+# by the RecognitionCache (0 disables it), queue_size frames decoded ahead of recognition,
+# decoder from DECODERS, profiles_path the calibration profiles (None to always search, see
+# locate_counter), and sparse_stride the sampling stride of a sparse scan (SPARSE_SCAN_STRIDE
+# when None). When set, dump_dir gets the cropped frames, checkpoint_dir the checkpoints of
+# runs to resume (see checkpoint.py) and result_log the per-frame results (see resultlog.py)
+DetectionOptions = namedtuple('DetectionOptions',
+                              RecognitionOptions._fields + ('cache_size', 'queue_size', 'decoder', 'profiles_path', 'sparse_stride',
+                                                            'dump_dir', 'checkpoint_dir', 'result_log'),
+                              defaults=list(RecognitionOptions._field_defaults.values()) + [RECOGNITION_CACHE_SIZE, DECODE_QUEUE_SIZE, DEFAULT_DECODER,
+                                                                                            CALIBRATION_PROFILES_PATH, None, None, None, None])
+
+# Marks the end of the decoded frames in the decode queue
+_END_OF_FRAMES = object()
 
 def crop_frame(frame, region):
     """Crop the frame based on the region (x, y, w, h)."""
@@ -20,99 +75,563 @@ def clear_directory(directory):
             except Exception as e:
                 print(f"Failed to delete {file_path}. Reason: {e}")
     else:
-        print(f"Directory {directory} does not exist. Creating...")
+        log(f"Directory {directory} does not exist. Creating...")
         os.makedirs(directory, exist_ok=True)
 
-def extract_frames(video_path):
-    """Extract frames from the video, rotate and process them."""
-    frames_dir = 'uploads/extracted_frames'
-    predefined_dir = 'uploads/predefined_digits'
+def crop_gray_roi(frame, region):
+    """Crop the region of interest and convert it to grayscale."""
+    cropped = crop_frame(frame, region)
+    if cropped.ndim == 3:
+        cropped = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
+    return cropped
+
+def rotated_region(region, frame_shape, rotate_cnt):
+    """Map a region of the frame turned rotate_cnt times counterclockwise onto the unrotated frame.
+
+    The region is clipped to the rotated frame first, like slicing the rotated frame would.
+    """
+    height, width = frame_shape[:2]
+    rotate_cnt %= 4
+    rotated_width, rotated_height = (height, width) if rotate_cnt % 2 else (width, height)
+
+    x, y, w, h = region
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = max(min(x + w, rotated_width), x0), max(min(y + h, rotated_height), y0)
+
+    if rotate_cnt == 1:
+        return (width - y1, x0, y1 - y0, x1 - x0)
+    if rotate_cnt == 2:
+        return (width - x1, height - y1, x1 - x0, y1 - y0)
+    if rotate_cnt == 3:
+        return (y0, height - x1, y1 - y0, x1 - x0)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+def crop_rotated_roi(frame, region, rotate_cnt):
+    """Grayscale ROI of the frame turned rotate_cnt times counterclockwise.
+
+    Only the cropped region is rotated, so the full frame is never rotated.
+    """
+    roi = crop_gray_roi(frame, rotated_region(region, frame.shape, rotate_cnt))
+    if rotate_cnt % 4:
+        roi = cv2.rotate(roi, ROTATE_CODES[rotate_cnt % 4])
+    return roi
+
+def orientation_confidence(frame, template_bank, region=REGION_OF_INTEREST, rotate_cnt=0):
+    """Lowest best-match SSIM over the digit slices of the region of the frame turned rotate_cnt times.
+
+    Returns -1 without cropping anything if the region does not lie entirely inside the frame,
+    as REGION_OF_INTEREST does not in frames of low resolution.
+    """
+    x, y, w, h = region
+    mapped = rotated_region(region, frame.shape, rotate_cnt)
+    mapped_size = (mapped[3], mapped[2]) if rotate_cnt % 2 else (mapped[2], mapped[3])
+    if x < 0 or y < 0 or w < NUM_DIGITS or h <= 0 or mapped_size != (w, h):
+        return -1
+    roi = crop_rotated_roi(frame, region, rotate_cnt)
+    return min(match.score for match in score_digit_slices(slice_image(roi, NUM_DIGITS), template_bank))
+
+def region_confidence(frames, template_bank, region, rotate_cnt):
+    """Mean orientation_confidence of the region over the frames turned rotate_cnt times."""
+    confidences = [orientation_confidence(frame, template_bank, region, rotate_cnt) for frame in frames]
+    return sum(confidences) / len(confidences)
 
-    # Clear the extracted frames directory
-    clear_directory(frames_dir)
+def detect_orientation(frames, template_bank, region=REGION_OF_INTEREST, similarity_threshold=0.8):
+    """Score all four rotations of the given frames in memory and pick the most confident one.
 
-    # Initialize video capture
+    Returns (rotate_cnt, confidence), with rotate_cnt None when no rotation reaches the
+    similarity threshold. The confidence of a rotation is its mean over the frames.
+    """
+    best_rotation, best_confidence = None, -1
+    for rotate_cnt in range(4):
+        confidence = region_confidence(frames, template_bank, region, rotate_cnt)
+        if confidence > best_confidence:
+            best_rotation, best_confidence = rotate_cnt, confidence
+
+    if best_confidence < similarity_threshold:
+        return None, best_confidence
+    return best_rotation, best_confidence
+
+def polish_region(frame, template_bank, region, rotate_cnt):
+    """Move the edges of the region by REGION_POLISH_OFFSETS and keep the best SSIM on the frame.
+
+    The template search and SSIM weigh pixels differently, so the best correlation can sit a
+    pixel away from the best SSIM; on small digits that pixel is enough to fail the threshold.
+    """
+    x, y, w, h = region
+    candidates = [(x + dx, y + dy, w + NUM_DIGITS * dp, h + dh) for dx, dy, dp, dh in itertools.product(REGION_POLISH_OFFSETS, repeat=4)]
+    return max(candidates, key=lambda candidate: region_confidence([frame], template_bank, candidate, rotate_cnt))
+
+def locate_counter(video_path, frames, template_bank, profiles_path=CALIBRATION_PROFILES_PATH, similarity_threshold=0.8, cancel_check=None):
+    """Find the region of the counter in the given frames and the rotation that makes it upright.
+
+    The calibration profile saved for the source of the video (see video_source_key) is tried
+    first, and when it still reads no search is done at all. Otherwise REGION_OF_INTEREST is
+    tried in every orientation, then the first frame is searched with search_counter and the
+    region it finds is polished with SSIM. Every candidate is checked with SSIM on all the
+    frames, and the one that reads is saved as the profile of the source. profiles_path None
+    disables the profiles. The search stops early once cancel_check() returns True.
+
+    Returns (rotate_cnt, region, confidence), with rotate_cnt None when the counter was not found.
+    """
+    key = video_source_key(video_path) if profiles_path is not None else None
+    if key is not None:
+        profile = load_profile(key, profiles_path)
+        if profile is not None:
+            confidence = region_confidence(frames, template_bank, profile.region, profile.rotate_cnt)
+            if confidence >= similarity_threshold:
+                log(f"Using the calibration profile of {key}: {profile.region} with {profile.rotate_cnt} rotation(s)")
+                return profile.rotate_cnt, profile.region, confidence
+            log(f"Calibration profile of {key} does not match (SSIM: {confidence}), searching again")
+
+    region = REGION_OF_INTEREST
+    rotate_cnt, confidence = detect_orientation(frames, template_bank, region, similarity_threshold)
+    if rotate_cnt is None:
+        location = search_counter(frames[0], template_bank.images.values(), cancel_check=cancel_check)
+        if location is not None:
+            found_region = polish_region(frames[0], template_bank, location.region, location.rotate_cnt)
+            found_confidence = region_confidence(frames, template_bank, found_region, location.rotate_cnt)
+            log(f"Counter search found {found_region} with {location.rotate_cnt} rotation(s) (SSIM: {found_confidence})")
+            if found_confidence >= similarity_threshold:
+                region, rotate_cnt = found_region, location.rotate_cnt
+            confidence = max(confidence, found_confidence)
+    if rotate_cnt is None:
+        return None, None, confidence
+
+    if key is not None:
+        save_profile(key, CounterLocation(region, rotate_cnt, confidence), profiles_path)
+    return rotate_cnt, region, confidence
+
+def iter_video_frames(video_path, metrics=None, start_frame=0, timestamps=None):
+    """Yield (frame_index, frame) for every frame decoded from the video, from start_frame on.
+
+    A start_frame is reached with a CAP_PROP_POS_FRAMES seek. With ProcessingMetrics, decoded
+    frames are counted and timed under the 'decode' stage, and the frames the container reports
+    from start_frame on become the expected total if none is set. With a timestamps dict, the
+    CAP_PROP_POS_MSEC position of every frame is stored in it under the frame index.
+    """
     cap = cv2.VideoCapture(video_path)
-    
+
     if not cap.isOpened():
         print(f"Error: Cannot open video file {video_path}")
         return
 
-    frame_count = 0
-    saved_frames = []
-    processing_complete = False
-    rotate_cnt = 0
-    while cap.isOpened():
-        ret, org_frame = cap.read()
+    if metrics is not None and metrics.total_frames is None:
+        metrics.total_frames = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) - start_frame, 0) or None
+    if start_frame:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+    try:
+        frame_index = start_frame
+        while True:
+            start = time.perf_counter()
+            ret, frame = cap.read()
+            if not ret:
+                log("End of video or cannot read the frame.")
+                break
+            if metrics is not None:
+                metrics.observe('decode', time.perf_counter() - start)
+                metrics.count('frames_decoded')
+            if timestamps is not None:
+                timestamps[frame_index] = cap.get(cv2.CAP_PROP_POS_MSEC)
+            yield frame_index, frame
+            frame_index += 1
+    finally:
+        # Release video capture
+        cap.release()
+
+class RoiReader:
+    """Reads the grayscale ROI of arbitrary frame indices, seeking with CAP_PROP_POS_FRAMES.
+
+    Short jumps forward are decoded with grab() instead, which is cheaper than a seek.
+    """
+
+    def __init__(self, video_path, rotate_cnt, region=REGION_OF_INTEREST):
+        self.cap = cv2.VideoCapture(video_path)
+        self.rotate_cnt = rotate_cnt
+        self.region = region
+        self.position = 0
+        self.timestamp_ms = float('nan')
+
+    def read(self, frame_index):
+        """Return the ROI of the frame, or None if the frame cannot be read.
+
+        The CAP_PROP_POS_MSEC position of the frame read last is kept in timestamp_ms.
+        """
+        if self.position is None or not 0 <= frame_index - self.position <= SEEK_DISTANCE:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            self.position = frame_index
+
+        while self.position < frame_index:
+            if not self.cap.grab():
+                self.position = None
+                return None
+            self.position += 1
+
+        ret, frame = self.cap.read()
         if not ret:
-            print("End of video or cannot read the frame.")
-            break
-
-        initial_frame = org_frame
-        if not processing_complete:
-            frame_found = False
-            
-            frame = initial_frame
-            for _ in range(4):
-                # Rotate frame 90 degrees counterclockwise
-                # cv2.imshow("frame",frame)
-                # cv2.waitKey(0)
-                
-                initial_frame = frame
-                # cv2.imshow("frame",frame)
-                # cv2.waitKey(0)
-                # Define region of interest (change this as needed)
-                region_of_interest = (200, 200, 250, 50)
-                frame = crop_frame(frame, region_of_interest)
-                
-                # Clear frames directory for new frame comparison
-                clear_directory(frames_dir)
-                
-                # Save the current frame for processing
-                frame_filename = os.path.join(frames_dir, f'frame_{frame_count}.png')
-                cv2.imwrite(frame_filename, frame)
-                saved_frames.append(frame_filename)
-                
-                # Process frame using SSIM and predefined data
-                val = process_all_images_in_directory(frames_dir, predefined_dir, use_ssim=True, check_valid_digits_in_frame=True)
-                print(val)
-                if val:
-                    frame_found = True
-                    clear_directory(frames_dir)
-                    print(f"Valid frame found at frame {frame_count}")
-                    break
-
-                frame = cv2.rotate(initial_frame, cv2.ROTATE_90_COUNTERCLOCKWISE)
-                rotate_cnt += 1
-
-
-            if not frame_found:
-                print("Invalid frame detected. Exiting...")
-                return False
-
-            processing_complete = True
-
-        # Crop original frame and save
-        for i in range(rotate_cnt):
-            frame = cv2.rotate(org_frame, cv2.ROTATE_90_COUNTERCLOCKWISE)
-            org_frame = frame
-            # cv2.imshow("frame",frame)
-            # cv2.waitKey(0)
-            
-        
-        region_of_interest = (200, 200, 250, 50)
-        cropped_frame = crop_frame(org_frame, region_of_interest)
-        frame_filename = os.path.join(frames_dir, f'frame_{frame_count}.png')
-        cv2.imwrite(frame_filename, cropped_frame)
-        saved_frames.append(frame_filename)
-        
-        frame_count += 1
-
-    # Release video capture
-    cap.release()
+            self.position = None
+            return None
+        self.position += 1
+        self.timestamp_ms = self.cap.get(cv2.CAP_PROP_POS_MSEC)
+        return crop_rotated_roi(frame, self.region, self.rotate_cnt)
+
+    def frame_count(self):
+        """Number of readable frames, checked by reading around CAP_PROP_FRAME_COUNT."""
+        count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        # The reported count can be off, so find where reading actually stops
+        while count > 0 and self.read(count - 1) is None:
+            count -= 1
+        while self.read(count) is not None:
+            count += 1
+        return count
+
+    def release(self):
+        self.cap.release()
+
+def iter_cropped_frames(frames, rotate_cnt, region=REGION_OF_INTEREST, metrics=None):
+    """Yield (frame_index, grayscale ROI) for each decoded frame.
+
+    With ProcessingMetrics, cropping is timed under the 'crop' stage.
+    """
+    for frame_index, frame in frames:
+        if metrics is not None:
+            with metrics.timed('crop'):
+                roi = crop_rotated_roi(frame, region, rotate_cnt)
+        else:
+            roi = crop_rotated_roi(frame, region, rotate_cnt)
+        yield frame_index, roi
+
+def dump_frames(rois, dump_dir):
+    """Pass the (frame_index, ROI) items through, writing every ROI to dump_dir as a PNG."""
+    os.makedirs(dump_dir, exist_ok=True)
+    for frame_index, roi in rois:
+        cv2.imwrite(os.path.join(dump_dir, f'frame_{frame_index}.png'), roi)
+        yield frame_index, roi
+
+def stream_cropped_frames(video_path, template_bank, dump_dir=None, probe_frames=ORIENTATION_PROBE_FRAMES, metrics=None, decoder=DEFAULT_DECODER, profiles_path=CALIBRATION_PROFILES_PATH,
+                          start_frame=0, location=None, cancel_check=None, timestamps=None):
+    """Locate the counter on the first frames and stream (frame_index, grayscale ROI) from start_frame on.
+
+    The counter is located with locate_counter, and always scored with SSIM, whichever matcher
+    recognizes the digits; a known (rotate_cnt, region) location skips that step. The probe
+    frames are decoded with OpenCV. With the ffmpeg decoder, the video is then decoded again
+    by FFmpeg, which only outputs the rotated grayscale ROI. A timestamps dict is filled as by
+    iter_video_frames, for the frames decoded by OpenCV only.
+
+    Returns (rotate_cnt, region, rois), or None if the video cannot be read, no orientation
+    shows a valid counter, or cancel_check() returned True while the counter was located.
+    """
+    frames = iter_video_frames(video_path, metrics, start_frame, timestamps)
+    first_frames = list(itertools.islice(frames, probe_frames))
+    if not first_frames:
+        return None
+
+    if location is not None:
+        rotate_cnt, region = location
+    else:
+        rotate_cnt, region, confidence = locate_counter(video_path, [frame for _, frame in first_frames], template_bank, profiles_path, cancel_check=cancel_check)
+        if rotate_cnt is None:
+            frames.close()
+            if cancel_check is None or not cancel_check():
+                print(f"Invalid frame detected (SSIM: {confidence}). Exiting...")
+            return None
+        log(f"Valid frame found at {region} with {rotate_cnt} rotation(s) (SSIM: {confidence})")
+
+    if decoder != 'opencv':
+        # Only needed, with the subprocess machinery it imports, when FFmpeg may decode
+        from ffmpeg_decode import FFMPEG_BINARY, FFmpegRoiReader, ffmpeg_available
+    if decoder == 'auto':
+        decoder = 'ffmpeg' if ffmpeg_available() else 'opencv'
+    if decoder == 'ffmpeg':
+        frames.close()
+        if not ffmpeg_available():
+            raise RuntimeError(f"FFmpeg decoder requested but {FFMPEG_BINARY} was not found")
+        source_region = rotated_region(region, first_frames[0][1].shape, rotate_cnt)
+        rois = FFmpegRoiReader(video_path, source_region, rotate_cnt, start_frame=start_frame).frames(metrics)
+    else:
+        rois = iter_cropped_frames(itertools.chain(first_frames, frames), rotate_cnt, region, metrics=metrics)
+
+    if dump_dir is not None:
+        rois = dump_frames(rois, dump_dir)
+    return rotate_cnt, region, rois
+
+def prefetch_frames(frames, queue_size=DECODE_QUEUE_SIZE):
+    """Run the frames iterator in a decoder thread and yield its items through a bounded queue.
+
+    The decoder blocks once queue_size items are waiting, which caps memory when recognition
+    is slower than decoding. Closing the generator stops the decoder thread.
+    """
+    decoded = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                decoded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def decode():
+        try:
+            for item in frames:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            # Release the video capture from the thread that reads it
+            if hasattr(frames, 'close'):
+                frames.close()
+            put(_END_OF_FRAMES)
+
+    decoder = threading.Thread(target=decode, name="frame-decoder", daemon=True)
+    decoder.start()
+    try:
+        while True:
+            item = decoded.get()
+            if item is _END_OF_FRAMES:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        decoder.join()
+
+def detect_missing_frames(video_path, options=DetectionOptions(), template_bank=None, cancel_check=None, on_missing=None, on_progress=None,
+                          metrics=None):
+    """Stream cropped frames from the video straight into digit recognition, as set by the DetectionOptions.
+
+    Returns (frame_count, missing_ranges), or False if no valid counter was found, where
+    missing_ranges lists the missing counter values as (start, end) ranges (see GapDetector).
+    Recognition stops once cancel_check() returns True; the frames read so far are then
+    counted and, with options.checkpoint_dir, checkpointed for a later run to resume.
+    on_missing(start, end) is called as soon as each gap is known, and on_progress with the
+    snapshot() of metrics (a new ProcessingMetrics if not given) as the frames go by.
+    """
+    if template_bank is None:
+        template_bank = DigitTemplateBank(options.predefined_dir)
+    recognizer, options = load_recognizer(options, template_bank)
+    if metrics is None:
+        metrics = ProcessingMetrics()
+    if on_progress is not None:
+        metrics.on_progress = on_progress
+
+    gap_detector = GapDetector(on_gap=on_missing)
+    metrics.gaps = gap_detector
+    # Counter value, weakest digit score and margin and timestamp of every frame processed so
+    # far, as machine values for the checkpoints and the result log
+    numbers = array('i')
+    confidences = array('f')
+    margins = array('f')
+    timestamps = array('d')
+    # Timestamps of the frames decoded but not recognized yet, filled by the decoder thread
+    pending_timestamps = {}
+    checkpoint = load_checkpoint(video_path, options.checkpoint_dir) if options.checkpoint_dir is not None else None
+    location = None
+    if checkpoint is not None:
+        log(f"Resuming {video_path} at frame {checkpoint.next_frame}")
+        numbers.extend(checkpoint.numbers.tolist())
+        confidences.extend(checkpoint.confidences.tolist())
+        margins.extend(checkpoint.margins.tolist())
+        timestamps.extend(checkpoint.timestamps.tolist())
+        for number in numbers:
+            if number != UNREADABLE:
+                gap_detector.add(number)
+        metrics.count('frames_resumed', len(numbers))
+        location = (checkpoint.rotate_cnt, checkpoint.region)
+
+    stream = stream_cropped_frames(video_path, template_bank, dump_dir=options.dump_dir, metrics=metrics, decoder=options.decoder, profiles_path=options.profiles_path,
+                                   start_frame=len(numbers), location=location, cancel_check=cancel_check, timestamps=pending_timestamps)
+    if stream is None:
+        if checkpoint is None:
+            if cancel_check is not None and cancel_check():
+                return len(numbers), gap_detector.finish()
+            return False
+        # The checkpoint already holds every frame, so the run completes with none left to recognize
+        stream = (checkpoint.rotate_cnt, checkpoint.region, iter(()))
+    rotate_cnt, region, rois = stream
+    rois = prefetch_frames(rois, options.queue_size)
+    cache = RecognitionCache(options.cache_size) if options.cache_size else None
+    metrics.cache = cache
+
+    def checkpoint_progress():
+        save_checkpoint(video_path, Checkpoint(video_identity(video_path), len(numbers), numbers, rotate_cnt, region, confidences, timestamps, margins), options.checkpoint_dir)
+
+    last_checkpoint = time.monotonic()
+    if options.workers is not None and options.workers > 1:
+        results = recognize_frames_parallel(rois, options, cancel_check=cancel_check, cache=cache, metrics=metrics, with_confidence=True)
+    else:
+        results = recognize_frames(rois, options, template_bank=recognizer, cancel_check=cancel_check, cache=cache, metrics=metrics, with_confidence=True)
+
+    completed = False
+    try:
+        for frame_index, final_number, confidence, margin in results:
+            numbers.append(UNREADABLE if final_number is None else int(final_number))
+            confidences.append(confidence)
+            margins.append(margin)
+            timestamps.append(pending_timestamps.pop(frame_index, float('nan')))
+            metrics.report_progress()
+            if final_number is not None:
+                gap_detector.add(int(final_number))
+            if options.checkpoint_dir is not None and time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                checkpoint_progress()
+                last_checkpoint = time.monotonic()
+        completed = cancel_check is None or not cancel_check()
+    finally:
+        rois.close()
+        if options.checkpoint_dir is not None:
+            if completed:
+                remove_checkpoint(video_path, options.checkpoint_dir)
+            elif numbers:
+                checkpoint_progress()
+                log(f"Checkpointed {video_path} at frame {len(numbers)}")
+
+    frame_count = len(numbers)
+    missing_ranges = gap_detector.finish()
+    if options.result_log is not None:
+        write_result_log(options.result_log, {'frame': range(frame_count), 'number': numbers, 'confidence': confidences, 'margin': margins, 'timestamp_ms': timestamps},
+                         video=os.path.abspath(video_path), completed=completed, rotate_cnt=rotate_cnt, region=list(region), use_ssim=options.use_ssim,
+                         model=options.model_path, missing_ranges=missing_ranges)
+    metrics.report_progress(force=True)
+    if cache is not None:
+        log(f"Recognition cache: {cache.stats()}")
+    log(f"Gaps: {gap_detector.stats()}")
+    log(missing_ranges)
+    return frame_count, missing_ranges
+
+def detect_missing_frames_sparse(video_path, options=DetectionOptions(), template_bank=None, cancel_check=None):
+    """Find the missing frames while decoding only a fraction of the video.
+
+    Every options.sparse_stride-th frame is sampled with a seek. An interval whose counter
+    advanced by exactly its length in frames holds no gap and is not decoded any further; the
+    other intervals are bisected down to single frames. Returns the same (frame_count,
+    missing_ranges) as detect_missing_frames provided the counter is readable in every frame
+    and never repeats or steps back, or False if no valid counter was found. Sampling stops
+    once cancel_check() returns True. The result log only holds the frames that were sampled.
+    """
+    if template_bank is None:
+        template_bank = DigitTemplateBank(options.predefined_dir)
+    recognizer, options = load_recognizer(options, template_bank)
+    stride = options.sparse_stride or SPARSE_SCAN_STRIDE
+
+    frames = iter_video_frames(video_path)
+    first_frames = [frame for _, frame in itertools.islice(frames, ORIENTATION_PROBE_FRAMES)]
+    frames.close()
+    if not first_frames:
+        return False
+
+    rotate_cnt, region, confidence = locate_counter(video_path, first_frames, template_bank, options.profiles_path)
+    if rotate_cnt is None:
+        print(f"Invalid frame detected (SSIM: {confidence}). Exiting...")
+        return False
+    log(f"Valid frame found at {region} with {rotate_cnt} rotation(s) (SSIM: {confidence})")
+
+    cache = RecognitionCache(options.cache_size) if options.cache_size else None
+    reader = RoiReader(video_path, rotate_cnt, region)
+    numbers = {}
+    # (confidence, margin, timestamp) of every sampled frame, for the result log
+    samples_read = {}
+
+    def number_at(frame_index):
+        if frame_index not in numbers:
+            roi = reader.read(frame_index)
+            final_number, confidence, margin = (None, float('nan'), float('nan')) if roi is None else score_frame(roi, recognizer, options.use_ssim, cache=cache)
+            numbers[frame_index] = None if final_number is None else int(final_number)
+            samples_read[frame_index] = (confidence, margin, reader.timestamp_ms if roi is not None else float('nan'))
+        return numbers[frame_index]
+
+    try:
+        frame_count = reader.frame_count()
+        samples = list(range(0, frame_count, stride))
+        if samples and samples[-1] != frame_count - 1:
+            samples.append(frame_count - 1)
+
+        # Frame ranges whose counter values are known to be present, as (first, last)
+        covered = [(0, 0)] if len(samples) == 1 and number_at(0) is not None else []
+        # Intervals still to check, popped in frame order
+        intervals = list(zip(samples, samples[1:]))[::-1]
+        while intervals:
+            if cancel_check is not None and cancel_check():
+                break
+            start, end = intervals.pop()
+            first, last = number_at(start), number_at(end)
+            if first is not None and last is not None and (last - first) % COUNTER_MODULUS == end - start:
+                covered.append((start, end))
+            elif end - start == 1:
+                covered.extend((frame_index, frame_index) for frame_index in (start, end) if numbers[frame_index] is not None)
+            else:
+                middle = (start + end) // 2
+                intervals.append((middle, end))
+                intervals.append((start, middle))
+    finally:
+        reader.release()
+
+    log(f"Sparse scan recognized {len(numbers)} of {frame_count} frames")
+    # Unwrapped in frame order, like the GapDetector of a full scan, so gaps across the rollover stay small
+    readable = sorted(frame_index for frame_index, number in numbers.items() if number is not None)
+    values = dict(zip(readable, unwrap_numbers([numbers[frame_index] for frame_index in readable]).tolist()))
+    missing_ranges = missing_ranges_between([(values[first], values[last]) for first, last in covered])
+    if options.result_log is not None:
+        sampled = sorted(numbers)
+        write_result_log(options.result_log, {'frame': sampled, 'number': [UNREADABLE if numbers[i] is None else numbers[i] for i in sampled],
+                                      'confidence': [samples_read[i][0] for i in sampled], 'margin': [samples_read[i][1] for i in sampled],
+                                      'timestamp_ms': [samples_read[i][2] for i in sampled]},
+                         video=os.path.abspath(video_path), completed=not intervals, rotate_cnt=rotate_cnt, region=list(region), use_ssim=options.use_ssim,
+                         model=options.model_path, missing_ranges=missing_ranges, sparse_stride=stride, frame_count=frame_count)
+    log(missing_ranges)
+    return frame_count, missing_ranges
+
+def extracted_frame_count(frames_dir):
+    """Number of consecutive frames, from frame 0, already extracted to the directory."""
+    indices = set()
+    if os.path.isdir(frames_dir):
+        for filename in os.listdir(frames_dir):
+            match = re.fullmatch(r'frame_(\d+)\.png', filename)
+            if match:
+                indices.add(int(match.group(1)))
+    count = 0
+    while count in indices:
+        count += 1
+    return count
+
+def extract_frames(video_path, cancel_check=None, resume=False):
+    """Extract the cropped frames of the video to the extracted frames directory.
+
+    With resume, the frames already in the directory are kept and extraction seeks past them;
+    otherwise the directory is cleared first. Extraction stops once cancel_check() returns True,
+    and can then be resumed.
+    """
+    frames_dir = EXTRACTED_FRAMES_DIR
+    template_bank = DigitTemplateBank(PREDEFINED_DIGITS_DIR)
+
+    start_frame = extracted_frame_count(frames_dir) if resume else 0
+    if not start_frame:
+        # Clear the extracted frames directory
+        clear_directory(frames_dir)
+
+    stream = stream_cropped_frames(video_path, template_bank, dump_dir=frames_dir, start_frame=start_frame, cancel_check=cancel_check)
+    if stream is None:
+        # Resuming past the last frame means every frame was already extracted
+        return (start_frame, []) if start_frame else False
+
+    frame_count = start_frame
+    saved_frames = []
+    rois = stream[2]
+    try:
+        for frame_index, _ in rois:
+            saved_frames.append(os.path.join(frames_dir, f'frame_{frame_index}.png'))
+            frame_count += 1
+            if cancel_check is not None and cancel_check():
+                break
+    finally:
+        rois.close()
 
     # Return frame count and a subset of the saved frames
     return frame_count, saved_frames[:5]
 
-# Example usage
-extract_frames(video_path='assets/video.mp4')
+if __name__ == "__main__":
+    # Example usage
+    extract_frames(video_path='assets/video.mp4')
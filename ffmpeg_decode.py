@@ -0,0 +1,126 @@
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+
+# FFmpeg executable, overridable for installs outside the PATH
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+
+# Frames read from the pipe with a single call, and held in the ring buffer
+FFMPEG_RING_FRAMES = 64
+
+# Filters turning the cropped region rotate_cnt times counterclockwise
+ROTATE_FILTERS = {1: 'transpose=2', 2: 'hflip,vflip', 3: 'transpose=1'}
+
+def ffmpeg_available():
+    return shutil.which(FFMPEG_BINARY) is not None
+
+def ffmpeg_roi_filters(source_region, rotate_cnt, start_frame=0):
+    """Filter graph cropping the source region out of every frame from start_frame on, in gray.
+
+    The frame is turned gray before it is cropped: on subsampled input like yuv420p the crop
+    would otherwise round an odd x, y, w or h down to an even one.
+    """
+    x, y, w, h = source_region
+    filters = [f'trim=start_frame={start_frame}'] if start_frame else []
+    filters.append('format=gray')
+    filters.append(f'crop={w}:{h}:{x}:{y}:exact=1')
+    if rotate_cnt % 4:
+        filters.append(ROTATE_FILTERS[rotate_cnt % 4])
+    return ','.join(filters)
+
+def ffmpeg_roi_command(video_path, source_region, rotate_cnt, start_frame=0):
+    """Command line decoding only the source region of every frame, rotated and as raw gray8 bytes.
+
+    Frames are passed through as decoded (no frame rate conversion), so dropped frames are
+    neither duplicated nor filled in. Frames before start_frame are decoded but not output.
+    """
+    return [FFMPEG_BINARY, '-v', 'error', '-nostdin', '-i', video_path, '-an', '-sn',
+            '-vf', ffmpeg_roi_filters(source_region, rotate_cnt, start_frame), '-vsync', 'passthrough', '-f', 'rawvideo', '-pix_fmt', 'gray', '-']
+
+def ffmpeg_roi_shape(video_path, source_region, rotate_cnt):
+    """(height, width) of the ROI FFmpeg outputs for the first frame, or None if it output none.
+
+    The frame is written as a PGM image, whose header holds its size, as the raw stream has none.
+    """
+    command = [FFMPEG_BINARY, '-v', 'error', '-nostdin', '-i', video_path, '-an', '-sn', '-vf', ffmpeg_roi_filters(source_region, rotate_cnt),
+               '-frames:v', '1', '-f', 'image2pipe', '-c:v', 'pgm', '-']
+    header = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.split(maxsplit=3)
+    if len(header) < 4 or header[0] != b'P5':
+        return None
+    return int(header[2]), int(header[1])
+
+class FFmpegRoiReader:
+    """Streams the grayscale ROI of every frame from an FFmpeg process.
+
+    FFmpeg crops, rotates and converts to gray on its side, so only the ROI bytes cross the
+    pipe. They are read straight into a ring buffer of ring_frames ROIs, a block of frames per
+    read call, and every ROI is copied out of the ring as it is yielded so the consumer may keep
+    it as long as it likes. source_region is the ROI in unrotated frame coordinates (see
+    rotated_region), the frames are turned rotate_cnt times counterclockwise. Frames are read
+    from start_frame on.
+    """
+
+    def __init__(self, video_path, source_region, rotate_cnt, ring_frames=FFMPEG_RING_FRAMES, start_frame=0):
+        self.video_path = video_path
+        self.source_region = source_region
+        self.rotate_cnt = rotate_cnt
+        self.start_frame = start_frame
+        self.command = ffmpeg_roi_command(video_path, source_region, rotate_cnt, start_frame)
+        _, _, w, h = source_region
+        self.shape = (w, h) if rotate_cnt % 2 else (h, w)
+        self.ring = np.empty((ring_frames,) + self.shape, dtype=np.uint8)
+
+    def frames(self, metrics=None):
+        """Yield (frame_index, grayscale ROI) for every frame from start_frame on.
+
+        With ProcessingMetrics, frames are counted and their share of each pipe read is timed
+        under the 'decode' stage. Raises RuntimeError if FFmpeg outputs ROIs of another size
+        than self.shape, which the raw stream would otherwise be split up by.
+        """
+        shape = ffmpeg_roi_shape(self.video_path, self.source_region, self.rotate_cnt)
+        if shape is not None and shape != self.shape:
+            raise RuntimeError(f"FFmpeg crops {self.video_path} to {shape[1]}x{shape[0]} instead of {self.shape[1]}x{self.shape[0]}")
+        frame_size = self.ring[0].nbytes
+        with tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=errors, bufsize=0)
+            stopped = False
+            try:
+                frame_index = self.start_frame
+                while True:
+                    start = time.perf_counter()
+                    count = self._read_block(process.stdout, frame_size)
+                    if metrics is not None and count:
+                        metrics.observe('decode', (time.perf_counter() - start) / count, count)
+                        metrics.count('frames_decoded', count)
+                    for slot in range(count):
+                        yield frame_index, self.ring[slot].copy()
+                        frame_index += 1
+                    if count < len(self.ring):
+                        process.wait()
+                        break
+            finally:
+                # The consumer may stop early, FFmpeg is then killed rather than left blocked on the pipe
+                if process.poll() is None:
+                    stopped = True
+                    process.kill()
+                process.stdout.close()
+                returncode = process.wait()
+
+            if returncode != 0 and not stopped:
+                errors.seek(0)
+                message = errors.read().decode(errors='replace').strip()
+                print(f"Error: FFmpeg failed on {self.video_path} ({returncode}): {message}")
+
+    def _read_block(self, pipe, frame_size):
+        """Fill the ring from the pipe and return the number of whole frames read."""
+        buffer = memoryview(self.ring.reshape(-1))
+        filled = 0
+        while filled < len(buffer):
+            read = pipe.readinto(buffer[filled:])
+            if not read:
+                break
+            filled += read
+        return filled // frame_size
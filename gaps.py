@@ -0,0 +1,141 @@
+import heapq
+
+# The counter overlay has 5 digits, so it wraps from 99999 back to 00000
+COUNTER_MODULUS = 10 ** 5
+
+# Number of detected values held back to put slightly out-of-order frames back in place
+REORDER_WINDOW = 8
+
+class GapDetector:
+    """Finds the missing counter values in a stream of detected numbers, as (start, end) ranges.
+
+    Numbers are fed in frame order with add(). The last `window` of them are held in a heap and
+    released smallest first, so a number arriving up to `window` frames late is still put in
+    place; memory stays bounded by the window and the number of gaps, whatever the video length.
+    Values are unwrapped across the 99999 -> 0 rollover, so a wrap is not mistaken for a gap,
+    and a gap spanning the rollover is reported as two ranges. A number equal to the last
+    released one is counted as a duplicate; a smaller one arrived too late to be placed and is
+    counted as late. on_gap(start, end) is called as soon as a range is known to be missing.
+    """
+
+    def __init__(self, window=REORDER_WINDOW, modulus=COUNTER_MODULUS, on_gap=None):
+        self.window = window
+        self.modulus = modulus
+        self.on_gap = on_gap
+        self.ranges = []
+        self.numbers_seen = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.late = 0
+        self.missing_count = 0
+        self.largest_gap = 0
+        self.first = None
+        self.last = None
+        self._pending = []
+        self._highest = None
+
+    def add(self, number):
+        """Feed the next detected counter value (0 <= number < modulus)."""
+        self.numbers_seen += 1
+        value = self._unwrap(number)
+        if self._highest is not None and value < self._highest:
+            self.reordered += 1
+        self._highest = value if self._highest is None else max(self._highest, value)
+
+        heapq.heappush(self._pending, value)
+        if len(self._pending) > self.window:
+            self._release(heapq.heappop(self._pending))
+
+    def finish(self):
+        """Release the numbers still held back and return the missing ranges."""
+        while self._pending:
+            self._release(heapq.heappop(self._pending))
+        return self.ranges
+
+    def stats(self):
+        return {
+            'numbers_seen': self.numbers_seen,
+            'first': None if self.first is None else self.first % self.modulus,
+            'last': None if self.last is None else self.last % self.modulus,
+            'wraps': 0 if self.first is None else self.last // self.modulus - self.first // self.modulus,
+            'missing_count': self.missing_count,
+            'gap_count': len(self.ranges),
+            'largest_gap': self.largest_gap,
+            'duplicates': self.duplicates,
+            'reordered': self.reordered,
+            'late': self.late,
+        }
+
+    def _unwrap(self, number):
+        # Place the number in the epoch closest to the highest value seen so far
+        if self._highest is None:
+            return number
+        epoch_start = self._highest - self._highest % self.modulus
+        value = epoch_start + number
+        if value < self._highest - self.modulus // 2:
+            value += self.modulus
+        elif value > self._highest + self.modulus // 2 and value >= self.modulus:
+            value -= self.modulus
+        return value
+
+    def _release(self, value):
+        if self.last is None:
+            self.first = self.last = value
+            return
+        if value == self.last:
+            self.duplicates += 1
+            return
+        if value < self.last:
+            self.late += 1
+            return
+
+        if value - self.last > 1:
+            self._add_gap(self.last + 1, value - 1)
+        self.last = value
+
+    def _add_gap(self, start, end):
+        self.missing_count += end - start + 1
+        self.largest_gap = max(self.largest_gap, end - start + 1)
+        for gap in counter_ranges(start, end, self.modulus):
+            self.ranges.append(gap)
+            if self.on_gap is not None:
+                self.on_gap(*gap)
+
+def counter_ranges(start, end, modulus=COUNTER_MODULUS):
+    """Yield the unwrapped range start..end in counter values, split where it crosses the rollover."""
+    while start <= end:
+        epoch_end = min(end, start - start % modulus + modulus - 1)
+        yield start % modulus, epoch_end % modulus
+        start = epoch_end + 1
+
+def missing_ranges(numbers, window=REORDER_WINDOW):
+    """Return the missing (start, end) ranges of the detected numbers, given in frame order."""
+    detector = GapDetector(window)
+    for number in numbers:
+        detector.add(number)
+    return detector.finish()
+
+def missing_ranges_between(covered, modulus=COUNTER_MODULUS):
+    """Return the (start, end) ranges missing between (first, last) ranges of present, unwrapped values.
+
+    The ranges are in counter values, split where they cross the rollover.
+    """
+    ranges = []
+    val = None
+    for first, last in sorted(covered):
+        if val is not None and first - val > 1:
+            ranges.extend(counter_ranges(val + 1, first - 1, modulus))
+        val = last if val is None else max(val, last)
+    return ranges
+
+def range_count(ranges):
+    """Number of values in the ranges."""
+    return sum(end - start + 1 for start, end in ranges)
+
+def expand_ranges(ranges):
+    """Every value of the ranges, in order."""
+    return [number for start, end in ranges for number in range(start, end + 1)]
+
+def format_ranges(ranges):
+    """Compact text for display, e.g. '110-111, 130'."""
+    return ', '.join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
@@ -0,0 +1,261 @@
+import time
+import queue
+import threading
+from collections import deque, namedtuple
+import cv2
+from metrics import ProcessingMetrics, log
+from gaps import GapDetector
+from extract import PREDEFINED_DIGITS_DIR, ORIENTATION_PROBE_FRAMES, locate_counter, crop_rotated_roi
+from ssim import RecognitionOptions, DigitTemplateBank, load_recognizer, frame_recognizer, is_borderline
+
+# Cropped frames a stream holds between capture and recognition; capture waits once it is full
+LIVE_QUEUE_SIZE = 64
+
+# Frames waiting for recognition beyond which a stream is reported as falling behind
+BACKLOG_WARNING = 8
+
+# A live source never reorders frames, so a gap is reported with the first frame after it
+LIVE_REORDER_WINDOW = 0
+
+# Seconds between two status reports of the streams
+STATUS_INTERVAL = 1.0
+
+# Seconds between two attempts to locate the counter of a stream that does not show it yet
+LOCATE_RETRY_INTERVAL = 1.0
+
+# A dropped range of counter values, seen in the source's frame_index, latency seconds after
+# that frame was captured
+DropEvent = namedtuple('DropEvent', ['source', 'start', 'end', 'frame_index', 'latency'])
+
+def open_source(source):
+    """Open a cv2.VideoCapture on a device index ('0', '1', ...), a file, a pipe or a stream URL."""
+    return cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+
+class LiveStream:
+    """Watches one live source for dropped frames, with a capture thread and a recognition thread.
+
+    The capture thread reads the source as fast as it delivers frames and, once the counter is
+    located, queues their grayscale ROI for the recognition thread; it only waits when
+    queue_size frames are already queued, which a source that cannot wait pays with frames of
+    its own, so the backlog is watched with status(). Until then the last few frames are kept
+    for the recognition thread to locate the counter on, again every LOCATE_RETRY_INTERVAL
+    seconds while it is not in view. Frames are recognized with the incremental and predictive
+    recognizers, and gaps are detected without a reorder window, so on_drop(DropEvent) is called
+    while the first frame after a drop is recognized. With pace, frames are read no faster than
+    the frame rate of the source, so that a file can stand in for a camera.
+    """
+
+    def __init__(self, source, template_bank, recognizer=None, use_ssim=True, on_drop=None, queue_size=LIVE_QUEUE_SIZE,
+                 backlog_warning=BACKLOG_WARNING, pace=False, similarity_threshold=0.8):
+        self.source = source
+        self.template_bank = template_bank
+        self.recognizer = recognizer if recognizer is not None else template_bank
+        self.use_ssim = use_ssim
+        self.on_drop = on_drop
+        self.backlog_warning = backlog_warning
+        self.pace = pace
+        self.similarity_threshold = similarity_threshold
+        self.metrics = ProcessingMetrics()
+        self.gaps = GapDetector(window=LIVE_REORDER_WINDOW, on_gap=self._report_drop)
+        self.metrics.gaps = self.gaps
+        self.drops = []
+        self.location = None
+        self.error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._probe = deque(maxlen=ORIENTATION_PROBE_FRAMES)
+        self._probe_changed = threading.Condition()
+        self._capture_ended = False
+        self._stop = threading.Event()
+        self._current = None
+        self._threads = [threading.Thread(target=self._capture, name=f"capture-{source}", daemon=True),
+                         threading.Thread(target=self._recognize, name=f"recognize-{source}", daemon=True)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._probe_changed:
+            self._probe_changed.notify_all()
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def status(self):
+        """Progress of the stream, with its backlog of frames waiting for recognition."""
+        status = self.metrics.snapshot()
+        backlog = self._queue.qsize()
+        status.update(
+            source=self.source,
+            state='running' if self.running() and self.location is not None else 'locating' if self.running() else 'ended',
+            backlog=backlog,
+            behind=backlog > self.backlog_warning,
+            capture_waits=status.get('capture_waits', 0),
+            drops=len(self.drops),
+            missing_count=self.gaps.missing_count,
+            error=self.error,
+        )
+        return status
+
+    def summary(self):
+        """Final status, with the latency statistics and the drop events of the stream."""
+        summary = dict(self.metrics.summary(), **self.status())
+        summary['drop_events'] = [event._asdict() for event in self.drops]
+        return summary
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            # A live source keeps going meanwhile, so every frame that has to wait is counted
+            self.metrics.count('capture_waits')
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _capture(self):
+        cap = open_source(self.source)
+        try:
+            if not cap.isOpened():
+                self.error = f"Cannot open source {self.source}"
+                return
+            fps = cap.get(cv2.CAP_PROP_FPS) if self.pace else 0
+            start = time.perf_counter()
+            frame_index = 0
+            while not self._stop.is_set():
+                if fps > 0:
+                    time.sleep(max(start + frame_index / fps - time.perf_counter(), 0))
+                ret, frame = cap.read()
+                if not ret:
+                    log(f"End of stream {self.source}")
+                    break
+                captured_at = time.perf_counter()
+                self.metrics.count('frames_decoded')
+                location = self.location
+                if location is None:
+                    with self._probe_changed:
+                        self._probe.append(frame)
+                        self._probe_changed.notify_all()
+                else:
+                    roi = crop_rotated_roi(frame, location[1], location[0])
+                    if not self._put((frame_index, captured_at, roi)):
+                        break
+                frame_index += 1
+        finally:
+            cap.release()
+            with self._probe_changed:
+                self._capture_ended = True
+                self._probe_changed.notify_all()
+
+    def _locate(self):
+        """Locate the counter on the latest frames; False if the stream ended or stopped first."""
+        while not self._stop.is_set():
+            with self._probe_changed:
+                self._probe.clear()
+                while len(self._probe) < self._probe.maxlen and not self._capture_ended and not self._stop.is_set():
+                    self._probe_changed.wait()
+                probe = list(self._probe)
+            if not probe:
+                return False
+            rotate_cnt, region, confidence = locate_counter(self.source, probe, self.template_bank, profiles_path=None,
+                                                            similarity_threshold=self.similarity_threshold, cancel_check=self._stop.is_set)
+            if rotate_cnt is not None:
+                log(f"Counter of {self.source} found at {region} with {rotate_cnt} rotation(s) (SSIM: {confidence})")
+                self.location = (rotate_cnt, region)
+                return True
+            if self._capture_ended:
+                self.error = f"No valid counter found (SSIM: {confidence})"
+                return False
+            log(f"No counter in {self.source} yet (SSIM: {confidence}), retrying")
+            self._stop.wait(LOCATE_RETRY_INTERVAL)
+        return False
+
+    def _recognize(self):
+        try:
+            self._recognize_frames()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self.stop()
+
+    def _recognize_frames(self):
+        if not self._locate():
+            return
+        recognize = frame_recognizer(self.recognizer, self.use_ssim, incremental=True, predictive=True)
+        while not self._stop.is_set():
+            try:
+                frame_index, captured_at, roi = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                # Capture only ends after queueing its last frame
+                if self._capture_ended:
+                    break
+                continue
+            self._current = (frame_index, captured_at)
+            start = time.perf_counter()
+            final_number, _, margin = recognize(roi)
+            now = time.perf_counter()
+            self.metrics.observe('recognize', now - start)
+            self.metrics.observe('capture_to_result', now - captured_at)
+            self.metrics.count('frames_recognized')
+            if final_number is None:
+                self.metrics.count('frames_unreadable')
+                log(f"Number not found in frame {frame_index} of {self.source}")
+            else:
+                if is_borderline(final_number, margin, self.use_ssim):
+                    self.metrics.count('frames_borderline')
+                    log(f"Borderline read in frame {frame_index} of {self.source}: {final_number} (margin: {margin})")
+                self.gaps.add(int(final_number))
+        self.gaps.finish()
+
+    def _report_drop(self, start, end):
+        frame_index, captured_at = self._current
+        event = DropEvent(self.source, start, end, frame_index, time.perf_counter() - captured_at)
+        self.drops.append(event)
+        if self.on_drop is not None:
+            self.on_drop(event)
+
+def monitor_streams(sources, predefined_dir=PREDEFINED_DIGITS_DIR, use_ssim=True, model_path=None, on_drop=None, on_status=None,
+                    interval=STATUS_INTERVAL, pace=False, duration=None, stop_check=None, queue_size=LIVE_QUEUE_SIZE):
+    """Watch every source with its own LiveStream until they all end, duration seconds pass, stop_check() returns True or Ctrl+C.
+
+    on_drop(DropEvent) is called from the recognition thread of the stream as soon as a drop
+    is seen, and on_status with the status() of every stream each interval seconds. With
+    model_path, digits are recognized by that DigitClassifier (see load_recognizer).
+    Returns the summary() of every stream.
+    """
+    template_bank = DigitTemplateBank(predefined_dir)
+    recognizer, options = load_recognizer(RecognitionOptions(predefined_dir, use_ssim, model_path), template_bank)
+    use_ssim = options.use_ssim
+
+    streams = [LiveStream(source, template_bank, recognizer, use_ssim, on_drop=on_drop, queue_size=queue_size, pace=pace) for source in sources]
+    deadline = time.time() + duration if duration is not None else None
+    next_status = time.time() + interval
+    for stream in streams:
+        stream.start()
+    try:
+        while any(stream.running() for stream in streams):
+            if stop_check is not None and stop_check():
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+            if on_status is not None and time.time() >= next_status:
+                next_status += interval
+                on_status([stream.status() for stream in streams])
+            time.sleep(0.05)
+    except KeyboardInterrupt:
+        print("Stopping streams...")
+    finally:
+        for stream in streams:
+            stream.stop()
+        for stream in streams:
+            stream.join()
+    return [stream.summary() for stream in streams]
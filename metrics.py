@@ -0,0 +1,147 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-slice scores and per-frame notes are only printed when verbose output is enabled
+VERBOSE = False
+
+# Upper bounds, in seconds, of the latency histogram buckets (the last bucket is unbounded)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Minimum number of seconds between two progress callbacks
+PROGRESS_INTERVAL = 0.5
+
+def set_verbose(enabled):
+    global VERBOSE
+    VERBOSE = enabled
+
+def is_verbose():
+    return VERBOSE
+
+def log(message):
+    """Print a diagnostic message, only when verbose output is enabled."""
+    if VERBOSE:
+        print(message)
+
+class LatencyHistogram:
+    """Counts latencies into fixed buckets and keeps their total, enough for a mean and percentiles."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds, count=1):
+        """Record count events that took seconds each."""
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += count
+        self.count += count
+        self.total += seconds * count
+        self.max = max(self.max, seconds)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of the events, at most the maximum."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        return {'count': self.count, 'mean': self.mean(), 'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95), 'max': self.max}
+
+class ProcessingMetrics:
+    """Throughput counters and per-stage latency histograms of one video.
+
+    Stages are observed from the decoder thread and the recognition loop at the same time,
+    so updates take a lock. With on_progress, snapshot() is passed to it at most every
+    interval seconds while frames are recognized.
+    """
+
+    def __init__(self, total_frames=None, on_progress=None, interval=PROGRESS_INTERVAL):
+        self.total_frames = total_frames
+        self.on_progress = on_progress
+        self.interval = interval
+        self.counters = {'frames_decoded': 0, 'frames_recognized': 0, 'frames_unreadable': 0, 'frames_borderline': 0}
+        self.stages = {}
+        self.cache = None
+        self.gaps = None
+        self.start_time = time.time()
+        self._last_progress = 0.0
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds, count=1):
+        """Record count items that took seconds each in the stage."""
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = LatencyHistogram()
+            histogram.observe(seconds, count)
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Current progress: counters, frames/s since the start, cache hit rate and ETA in seconds."""
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        with self._lock:
+            progress = dict(self.counters)
+        recognized = progress['frames_recognized']
+        progress.update(
+            elapsed=elapsed,
+            total_frames=self.total_frames,
+            decode_fps=progress['frames_decoded'] / elapsed,
+            recognition_fps=recognized / elapsed,
+            cache_hit_rate=self.cache.hit_rate() if self.cache is not None else None,
+            eta=None,
+        )
+        if self.total_frames and recognized:
+            progress['eta'] = max(self.total_frames - recognized, 0) * elapsed / recognized
+        return progress
+
+    def report_progress(self, force=False):
+        """Pass a snapshot to on_progress, unless one was passed less than interval seconds ago."""
+        if self.on_progress is None:
+            return
+        now = time.time()
+        if force or now - self._last_progress >= self.interval:
+            self._last_progress = now
+            self.on_progress(self.snapshot())
+
+    def summary(self):
+        """Final snapshot with the latency statistics of every stage."""
+        summary = self.snapshot()
+        with self._lock:
+            summary['stages'] = {stage: histogram.stats() for stage, histogram in self.stages.items()}
+        if self.gaps is not None:
+            summary['gaps'] = self.gaps.stats()
+        return summary
+
+def format_progress(progress):
+    """One-line description of a snapshot, for the progress labels of the apps."""
+    text = f"Processing... {progress['frames_recognized']}"
+    if progress['total_frames']:
+        text += f"/{progress['total_frames']}"
+    text += f" frames ({progress['recognition_fps']:.0f} frames/s"
+    if progress['eta'] is not None:
+        text += f", ETA {progress['eta']:.0f}s"
+    return text + ")"
@@ -0,0 +1,106 @@
+import os
+import json
+import numpy as np
+from gaps import COUNTER_MODULUS, counter_ranges
+from checkpoint import UNREADABLE, output_name
+from ssim import BORDERLINE_MARGIN
+
+# Result logs of detection runs, one directory per video
+RESULT_LOG_DIR = 'uploads/results'
+
+# Columns of a result log, one .npy file each: the frame index, its counter value (UNREADABLE
+# when not read), the score and margin of its weakest digits (see ssim.weakest_margin) and its
+# CAP_PROP_POS_MSEC position (NaN when the decoder does not report one)
+RESULT_COLUMNS = {'frame': np.int64, 'number': np.int32, 'confidence': np.float32, 'margin': np.float32, 'timestamp_ms': np.float64}
+
+def result_log_path(video_path, log_dir=RESULT_LOG_DIR):
+    """Result log directory of the video (see checkpoint.output_name)."""
+    return os.path.join(log_dir, output_name(video_path))
+
+def write_result_log(path, columns, **meta):
+    """Write the columns (a buffer or sequence per name of RESULT_COLUMNS) and meta.json to the directory.
+
+    Every file is replaced atomically, and meta.json, which records the length of the log,
+    is written last.
+    """
+    os.makedirs(path, exist_ok=True)
+    length = None
+    for name, dtype in RESULT_COLUMNS.items():
+        values = np.asarray(columns[name], dtype=dtype)
+        if length is not None and len(values) != length:
+            raise ValueError(f"Column {name} has {len(values)} values instead of {length}")
+        length = len(values)
+        # np.save appends .npy to names without it, so the temporary name keeps the extension
+        temp_path = os.path.join(path, f"{name}.{os.getpid()}.tmp.npy")
+        np.save(temp_path, values)
+        os.replace(temp_path, os.path.join(path, f"{name}.npy"))
+
+    meta['length'] = length
+    temp_path = os.path.join(path, f"meta.json.{os.getpid()}.tmp")
+    with open(temp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(temp_path, os.path.join(path, 'meta.json'))
+
+def unwrap_numbers(numbers, modulus=COUNTER_MODULUS):
+    """Counter values made monotonic across the 99999 -> 0 rollover, each step taken as the shortest way round."""
+    numbers = np.asarray(numbers, dtype=np.int64)
+    if len(numbers) == 0:
+        return numbers
+    steps = (np.diff(numbers) + modulus // 2) % modulus - modulus // 2
+    return np.concatenate((numbers[:1], numbers[0] + np.cumsum(steps)))
+
+class ResultLog:
+    """A result log opened for re-analysis, with every column memory-mapped read-only.
+
+    Nothing is read until a query touches it, and queries are vectorized over the columns, so
+    thresholds and gaps of a long run can be re-examined without decoding the video again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        for name in RESULT_COLUMNS:
+            column = np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+            if len(column) != self.meta['length']:
+                raise ValueError(f"Column {name} of {path} has {len(column)} values instead of {self.meta['length']}")
+            setattr(self, name, column)
+
+    def __len__(self):
+        return self.meta['length']
+
+    def readable(self, threshold=None):
+        """Mask of the frames whose counter was read, and scored at least threshold if given.
+
+        With MSE scores (use_ssim false in the meta), lower is better and threshold is the
+        largest error accepted. Frames not read during the run stay unreadable at any threshold.
+        """
+        mask = self.number != UNREADABLE
+        if threshold is not None:
+            mask &= (self.confidence >= threshold) if self.meta.get('use_ssim', True) else (self.confidence <= threshold)
+        return mask
+
+    def unreadable_frames(self, threshold=None):
+        """Indices of the frames that are not readable at the threshold."""
+        return self.frame[~self.readable(threshold)]
+
+    def borderline_frames(self, margin=BORDERLINE_MARGIN, threshold=None):
+        """Indices of the frames readable at the threshold whose least clear-cut digit was less than margin ahead of another."""
+        return self.frame[self.readable(threshold) & (self.margin < margin)]
+
+    def missing_ranges(self, threshold=None):
+        """Missing counter values, as (start, end) ranges, among the frames readable at the threshold.
+
+        The values are unwrapped across the rollover and sorted as a whole, so unlike the
+        GapDetector of a live run, out-of-order frames are put in place however late they came.
+        """
+        values = np.unique(unwrap_numbers(self.number[self.readable(threshold)]))
+        steps = np.diff(values)
+        gaps = zip((values[:-1][steps > 1] + 1).tolist(), (values[1:][steps > 1] - 1).tolist())
+        return [gap for start, end in gaps for gap in counter_ranges(start, end)]
+
+    def compare(self, other):
+        """Return (frames, numbers, other_numbers) for the frames both logs hold but read differently."""
+        frames, ours, theirs = np.intersect1d(self.frame, other.frame, assume_unique=True, return_indices=True)
+        differ = self.number[ours] != other.number[theirs]
+        return frames[differ], self.number[ours][differ], other.number[theirs][differ]
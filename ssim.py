@@ -1,9 +1,78 @@
 import cv2
 import os
 import time
+import itertools
+import hashlib
+import functools
+import multiprocessing
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
 import numpy as np
-from skimage.metrics import structural_similarity as ssim
-from extract import *
+from metrics import log, is_verbose, set_verbose
+from gaps import GapDetector
+
+# Parameters of skimage.metrics.structural_similarity that the batched SSIM reproduces
+SSIM_WIN_SIZE = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+SSIM_DATA_RANGE = 255
+SSIM_COV_NORM = SSIM_WIN_SIZE ** 2 / (SSIM_WIN_SIZE ** 2 - 1)
+
+# Default number of slice and ROI results kept by a RecognitionCache
+RECOGNITION_CACHE_SIZE = 4096
+
+# Mean absolute difference under which a digit slice counts as unchanged, as a fraction of
+# the gray-level standard deviation of the slice it is compared with. The closest glyphs (8
+# and 9) differ by about 0.09 of it whatever the contrast of the overlay
+SLICE_CHANGE_THRESHOLD = 0.03
+
+# Number of counter values after the previous one that are tried before full recognition
+PREDICTION_WINDOW = 3
+
+# Digit templates, one image per digit named after it
+PREDEFINED_DIGITS_DIR = 'uploads/predefined_digits'
+
+# Consecutive frames sent to a recognition worker at a time
+RECOGNITION_CHUNK_SIZE = 32
+
+# How frames are recognized: with the templates in predefined_dir, matched by SSIM (or MSE
+# without use_ssim), or with the DigitClassifier saved at model_path; incremental and
+# predictive pick the stateful recognizers of frame_recognizer; workers > 1 shards recognition
+# across that many processes (recognize_frames_parallel uses one per CPU when None)
+RecognitionOptions = namedtuple('RecognitionOptions', ['predefined_dir', 'use_ssim', 'model_path', 'incremental', 'predictive', 'workers'],
+                                defaults=[PREDEFINED_DIGITS_DIR, True, None, False, False, None])
+
+# Cells (rows, columns) of the coarse profile that ranks the templates of a slice before SSIM
+PROFILE_CELLS = (12, 8)
+
+# Templates per slice, closest by coarse profile first, that get a full SSIM (at least 2)
+CASCADE_CANDIDATES = 2
+
+# SSIM lead of the best candidate over the next one under which a slice is scored against
+# every template
+CASCADE_MARGIN = 0.05
+
+# SSIM of the best candidate under which a slice is scored against every template. A slice
+# that matches no candidate well, like a blend of two digits, may be closer still to a
+# template the coarse profiles ranked lower
+CASCADE_MIN_SCORE = 0.8
+
+# Lead of a digit over the next best one under which its frame is flagged as borderline. A
+# margin the cascade settled without every template is only measured against the other
+# candidates, so it is an upper bound: a template that was not scored may be closer
+BORDERLINE_MARGIN = 0.02
+
+# Slice pixels scored by SSIM at a time. Bigger batches are slower, because the temporaries
+# of batch_ssim then no longer fit in the CPU caches
+SSIM_BATCH_PIXELS = 12500
+
+# Templates of one slice shape stacked into (10, h, w) arrays, with their SSIM window statistics
+# and coarse profiles
+TemplateStack = namedtuple('TemplateStack', ['digits', 'images', 'mean', 'variance', 'profiles'])
+
+# Best digit of a slice, its score and its margin: how far it is ahead of the next best digit,
+# in the units of the score
+DigitMatch = namedtuple('DigitMatch', ['digit', 'score', 'margin'])
 
 def load_images_from_directory(directory):
     images = {}
@@ -13,128 +82,645 @@ def load_images_from_directory(directory):
             images[filename.split('.')[0]] = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
     return images
 
+@functools.lru_cache(maxsize=None)
+def window_averaging_matrix(size, win_size=SSIM_WIN_SIZE):
+    """Banded (size - win_size + 1, size) matrix that averages every run of win_size samples."""
+    matrix = np.zeros((size - win_size + 1, size))
+    for i in range(size - win_size + 1):
+        matrix[i, i:i + win_size] = 1.0 / win_size
+    return matrix
+
+def box_mean(images, win_size=SSIM_WIN_SIZE):
+    """Mean of every full win_size x win_size window over the last two axes of images.
+
+    Equivalent to the interior of a uniform filter. The window sums are two matrix
+    products with banded averaging matrices, so a whole stack is filtered by BLAS at once.
+    """
+    height, width = images.shape[-2:]
+    columns = window_averaging_matrix(width, win_size).T
+    rows = window_averaging_matrix(height, win_size)
+    averaged = (images.reshape(-1, width) @ columns).reshape(images.shape[:-1] + (columns.shape[1],))
+    return rows @ averaged
+
+@functools.lru_cache(maxsize=None)
+def cell_averaging_matrix(size, cells):
+    """(cells, size) matrix that averages size samples into cells runs of (nearly) equal length."""
+    matrix = np.zeros((cells, size))
+    for i in range(cells):
+        start, end = i * size // cells, (i + 1) * size // cells
+        matrix[i, start:end] = 1.0 / (end - start)
+    return matrix
+
+def coarse_profiles(images, cells=PROFILE_CELLS):
+    """Images over their last two axes averaged down to cells, flattened and normalized.
+
+    Every profile is centered and scaled to a mean absolute value of 1, so like SSIM it does
+    not depend on the brightness and contrast of the image.
+    """
+    height, width = images.shape[-2:]
+    columns = cell_averaging_matrix(width, min(cells[1], width)).T
+    rows = cell_averaging_matrix(height, min(cells[0], height))
+    averaged = (images.reshape(-1, width) @ columns).reshape(images.shape[:-1] + (columns.shape[1],))
+    profiles = (rows @ averaged).reshape(images.shape[:-2] + (-1,))
+    profiles = profiles - profiles.mean(axis=-1, keepdims=True)
+    return profiles / np.maximum(np.abs(profiles).mean(axis=-1, keepdims=True), 1e-9)
+
+class DigitTemplateBank:
+    """Digit templates loaded once from disk, with resized copies cached per slice shape."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.images = load_images_from_directory(directory)
+        self._resized = {}
+        self._stacked = {}
+
+    def resized(self, shape):
+        """Return the templates resized to ``shape`` (height, width) as a digit -> image dict."""
+        templates = self._resized.get(shape)
+        if templates is None:
+            height, width = shape
+            templates = {digit: cv2.resize(image, (width, height)) for digit, image in self.images.items()}
+            self._resized[shape] = templates
+        return templates
+
+    def stacked(self, shape):
+        """Return the TemplateStack of the templates resized to ``shape``."""
+        stack = self._stacked.get(shape)
+        if stack is None:
+            templates = self.resized(shape)
+            digits = list(templates)
+            images = np.stack([templates[digit] for digit in digits]).astype(np.float64)
+            mean = box_mean(images)
+            variance = SSIM_COV_NORM * (box_mean(images * images) - mean * mean)
+            stack = TemplateStack(digits, images, mean, variance, coarse_profiles(images))
+            self._stacked[shape] = stack
+        return stack
+
+    def score_batch(self, batch, use_ssim=True):
+        """Return the best digit of each slice in a (n, height, width) batch, its SSIM (or MSE) and its margin.
+
+        SSIM is a cascade: the templates are ranked by the L1 distance between their coarse
+        profiles and the slice's, and only the CASCADE_CANDIDATES closest get a full SSIM. A
+        slice whose best candidate is not CASCADE_MARGIN ahead of the next, or scores under
+        CASCADE_MIN_SCORE, is scored against every template. The other slices skip the rest of
+        the templates, and their margin is measured against the next candidate only, which makes
+        it an upper bound of the margin over every template. Large batches are split into blocks
+        of SSIM_BATCH_PIXELS.
+        """
+        stack = self.stacked(batch.shape[1:])
+        rows = np.arange(len(batch))
+        if not use_ssim:
+            scores = batch_mse(batch, stack)
+            order = scores.argsort(axis=1)
+            best, second = scores[rows, order[:, 0]], scores[rows, order[:, 1]]
+            return [int(stack.digits[i]) for i in order[:, 0]], best, second - best
+
+        block = max(1, SSIM_BATCH_PIXELS // (batch.shape[1] * batch.shape[2]))
+        if len(batch) > block:
+            parts = [self.score_batch(batch[i:i + block], use_ssim) for i in range(0, len(batch), block)]
+            return [digit for part in parts for digit in part[0]], np.concatenate([part[1] for part in parts]), np.concatenate([part[2] for part in parts])
+
+        x = np.asarray(batch, dtype=np.float64)
+        distances = np.abs(coarse_profiles(x)[:, None] - stack.profiles).mean(axis=-1)
+        candidates = distances.argsort(axis=1)[:, :CASCADE_CANDIDATES]
+        candidate_stack = TemplateStack(candidates, stack.images[candidates], stack.mean[candidates],
+                                        stack.variance[candidates], stack.profiles[candidates])
+        scores = np.full(distances.shape, -np.inf)
+        scores[rows[:, None], candidates] = batch_ssim(x, candidate_stack)
+        top = np.sort(scores, axis=1)
+        ambiguous = (top[:, -1] - top[:, -2] < CASCADE_MARGIN) | (top[:, -1] < CASCADE_MIN_SCORE)
+        if ambiguous.any():
+            scores[ambiguous] = batch_ssim(x[ambiguous], stack)
+            top = np.sort(scores, axis=1)
+        best = scores.argmax(axis=1)
+        return [int(stack.digits[i]) for i in best], top[:, -1], top[:, -1] - top[:, -2]
+
 def slice_image(image, num_slices):
-    height, width = image.shape
-    slice_width = width // num_slices
-    slices = []
-    for i in range(num_slices):
-        if i == 4:
-            digit_slice = image[:, i * slice_width + 1:(i + 2) * slice_width + 1]
-        else:
-            digit_slice = image[:, i * slice_width:(i + 1) * slice_width]
-        slices.append(digit_slice)
-    return slices
+    """Split the image into num_slices side-by-side slices, spreading any leftover columns evenly."""
+    width = image.shape[1]
+    bounds = [i * width // num_slices for i in range(num_slices + 1)]
+    return [image[:, bounds[i]:bounds[i + 1]] for i in range(num_slices)]
 
-def recognize_digit_ssim(digit_slice, predefined_digits_directory, similarity_threshold=0.8):
-    predefined_images = load_images_from_directory(predefined_digits_directory)
-    
-    best_match = None
-    highest_similarity = -1
-    
-    for digit, predefined_image in predefined_images.items():
-        predefined_resized = cv2.resize(predefined_image, (digit_slice.shape[1], digit_slice.shape[0]))
+def batch_ssim(digit_slices, stack):
+    """SSIM of each slice in an (n, h, w) stack against every template, as an (n, 10) array.
+
+    The stack may also hold k templates per slice, as (n, k, h, w) arrays, for an (n, k)
+    array. Matches skimage.metrics.structural_similarity with its default uniform window.
+    """
+    x = np.asarray(digit_slices, dtype=np.float64)
+    ux = box_mean(x)[:, None]
+    vx = SSIM_COV_NORM * (box_mean(x * x)[:, None] - ux * ux)
+    uxy = box_mean(x[:, None] * stack.images)
+
+    c1 = (SSIM_K1 * SSIM_DATA_RANGE) ** 2
+    c2 = (SSIM_K2 * SSIM_DATA_RANGE) ** 2
+    # Build the SSIM map in place on the (n, k, h, w) temporaries
+    luminance = ux * stack.mean
+    contrast = uxy
+    contrast -= luminance
+    contrast *= 2 * SSIM_COV_NORM
+    contrast += c2
+    luminance *= 2
+    luminance += c1
+    luminance *= contrast
+    denominator = (ux * ux + c1) + stack.mean * stack.mean
+    denominator *= (vx + c2) + stack.variance
+    luminance /= denominator
+    return luminance.mean(axis=(-2, -1))
+
+def batch_mse(digit_slices, stack):
+    """Mean squared error of each slice in an (n, h, w) stack against every template, as an (n, 10) array."""
+    x = np.asarray(digit_slices, dtype=np.float64)
+    return ((x[:, None] - stack.images[None]) ** 2).mean(axis=(-2, -1))
+
+class RecognitionCache:
+    """LRU cache of recognition results keyed by a hash of the pixels they were computed from.
+
+    Repeated digit slices and byte-identical ROIs (paused streams, duplicated frames) are
+    looked up here instead of being scored again. A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=RECOGNITION_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(kind, image, *params):
+        """Cache key for an image: its shape, a 128-bit BLAKE2 digest of its pixels and the scoring params."""
+        digest = hashlib.blake2b(np.ascontiguousarray(image).tobytes(), digest_size=16).digest()
+        return (kind, image.shape, digest) + params
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss."""
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
 
-        similarity = ssim(digit_slice, predefined_resized)
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
 
-        if similarity > highest_similarity:
-            highest_similarity = similarity
-            best_match = digit
-    print(f"ssim score: {highest_similarity}")
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate(), 'size': len(self._entries), 'max_size': self.max_size}
+
+def score_digit_slices(digit_slices, template_bank, use_ssim=True, cache=None):
+    """Return a DigitMatch for each slice, scoring all slices of one shape in a single pass.
+
+    The score is the SSIM of the best match, or its MSE when use_ssim is False. template_bank
+    may also be a DigitClassifier, whose confidence is the score. Slices found in the cache
+    are not scored again.
+    """
+    results = [None] * len(digit_slices)
+    keys = [None] * len(digit_slices)
+    groups = {}
+    for i, digit_slice in enumerate(digit_slices):
+        if cache is not None:
+            keys[i] = cache.key('slice', digit_slice, use_ssim)
+            results[i] = cache.get(keys[i])
+            if results[i] is not None:
+                continue
+        groups.setdefault(digit_slice.shape, []).append(i)
+
+    for shape, indices in groups.items():
+        digits, scores, margins = template_bank.score_batch(np.stack([digit_slices[i] for i in indices]), use_ssim)
+        for row, i in enumerate(indices):
+            results[i] = DigitMatch(digits[row], float(scores[row]), float(margins[row]))
+            if cache is not None:
+                cache.put(keys[i], results[i])
+    return results
+
+def recognize_digit_ssim(digit_slice, predefined_digits_directory, similarity_threshold=0.8, template_bank=None):
+    if template_bank is None:
+        template_bank = DigitTemplateBank(predefined_digits_directory)
+
+    best_match, highest_similarity, _ = score_digit_slices([digit_slice], template_bank)[0]
+    log(f"ssim score: {highest_similarity}")
     # Check if the highest similarity is below the threshold
     if highest_similarity < similarity_threshold:
-        print(f"No match found for slice (SSIM: {highest_similarity}).")
+        log(f"No match found for slice (SSIM: {highest_similarity}).")
         return None  # Indicating no match found
 
-    return int(best_match)
+    return best_match
 
 def mse(imageA, imageB):
     err = np.sum((imageA.astype("float") - imageB.astype("float")) ** 2)
     err /= float(imageA.shape[0] * imageA.shape[1])
     return err
 
-def recognize_digit_mse(digit_slice, predefined_digits_directory):
-    predefined_images = load_images_from_directory(predefined_digits_directory)
-    
-    best_match = None
-    lowest_error = float("inf")
-    
-    for digit, predefined_image in predefined_images.items():
-        predefined_resized = cv2.resize(predefined_image, (digit_slice.shape[1], digit_slice.shape[0]))
+def recognize_digit_mse(digit_slice, predefined_digits_directory, template_bank=None):
+    if template_bank is None:
+        template_bank = DigitTemplateBank(predefined_digits_directory)
 
-        error = mse(digit_slice, predefined_resized)
-
-        if error < lowest_error:
-            lowest_error = error
-            best_match = digit
-
-    return int(best_match)
-
-def process_image(input_image_path, predefined_digits_directory, use_ssim=True):
-    input_image = cv2.imread(input_image_path, cv2.IMREAD_GRAYSCALE)
-    
-    num_slices = 5  
-    digit_slices = slice_image(input_image, num_slices)
+    best_match, lowest_error, _ = score_digit_slices([digit_slice], template_bank, use_ssim=False)[0]
+    return best_match
 
+def combine_digits(scored_slices, use_ssim=True, similarity_threshold=0.8):
+    """Join the DigitMatch of every slice of a frame into its number, or None if a slice matched no template."""
     detected_number = []
-    for digit_slice in digit_slices:
+    for recognized_digit, score, _ in scored_slices:
         if use_ssim:
-            recognized_digit = recognize_digit_ssim(digit_slice, predefined_digits_directory)
-        else:
-            recognized_digit = recognize_digit_mse(digit_slice, predefined_digits_directory)
-        
-        if recognized_digit is None:  # If no match found
-            print("Number not found")
-            return None  # Break out and return if any digit is not recognized
+            log(f"ssim score: {score}")
+            # Check if the highest similarity is below the threshold
+            if score < similarity_threshold:
+                log(f"No match found for slice (SSIM: {score}).")
+                log("Number not found")
+                return None  # Break out and return if any digit is not recognized
         
         detected_number.append(recognized_digit)
 
     final_number = ''.join(map(str, detected_number))
     return final_number
 
-def process_all_images_in_directory(directory, predefined_digits_dir, use_ssim=True,check_valid_digits_in_frame=False):
-    final_outputs = {}
-    missing_frames = []
+def weakest_score(scored_slices, use_ssim=True):
+    """Score of the least certain digit of a frame: the lowest SSIM (or confidence), or the highest MSE."""
+    scores = [match.score for match in scored_slices]
+    if not scores:
+        return float('nan')
+    return min(scores) if use_ssim else max(scores)
 
+def weakest_margin(scored_slices):
+    """Smallest margin of the digits of a frame: how close its least clear-cut digit came to another."""
+    return min((match.margin for match in scored_slices), default=float('nan'))
 
-    if check_valid_digits_in_frame:
+def is_borderline(number, margin, use_ssim=True):
+    """Whether a frame was read with a digit less than BORDERLINE_MARGIN ahead of another.
 
-        for filename in os.listdir(directory):
-            if filename.endswith('.png') or filename.endswith('.jpg'):
-                image_path = os.path.join(directory, filename)
-                final_number = process_image(image_path, predefined_digits_dir, use_ssim)
-                if final_number is None:
-                    print(f"Number not found in image: {filename}")
-                    return False
-                else:
-                    return True
+    Only SSIM and classifier margins are held against it; MSE margins are in other units.
+    """
+    return use_ssim and number is not None and margin < BORDERLINE_MARGIN
+
+def score_frame(input_image, template_bank, use_ssim=True, similarity_threshold=0.8, cache=None):
+    """Recognize the counter in a grayscale ROI and return (number, confidence, margin).
+
+    number is None when a digit matched no template, and the confidence and margin are the
+    weakest_score and weakest_margin of the digits either way. With a RecognitionCache, an ROI
+    whose pixels were already recognized is answered from the cache, and so are individual
+    digit slices seen before.
+    """
+    return score_frames([input_image], template_bank, use_ssim, similarity_threshold, cache)[0]
+
+def score_frames(input_images, template_bank, use_ssim=True, similarity_threshold=0.8, cache=None):
+    """Recognize many grayscale ROIs at once, returning score_frame's result for each.
+
+    The digit slices of all the ROIs are scored together, so every slice shape is one
+    score_batch call (one matrix multiply with a DigitClassifier) whatever the number of ROIs.
+    """
+    num_slices = 5
+    results = [None] * len(input_images)
+    roi_keys = [None] * len(input_images)
+    pending = []
+    for i, input_image in enumerate(input_images):
+        if cache is not None:
+            roi_keys[i] = cache.key('roi', input_image, use_ssim, similarity_threshold)
+            results[i] = cache.get(roi_keys[i])
+            if results[i] is not None:
+                continue
+        pending.append(i)
+
+    digit_slices = [digit_slice for i in pending for digit_slice in slice_image(input_images[i], num_slices)]
+    matches = score_digit_slices(digit_slices, template_bank, use_ssim, cache=cache)
+    for n, i in enumerate(pending):
+        scored_slices = matches[n * num_slices:(n + 1) * num_slices]
+        results[i] = (combine_digits(scored_slices, use_ssim, similarity_threshold), weakest_score(scored_slices, use_ssim), weakest_margin(scored_slices))
+        if cache is not None:
+            cache.put(roi_keys[i], results[i])
+    return results
+
+def process_frame(input_image, predefined_digits_directory, use_ssim=True, template_bank=None, similarity_threshold=0.8, cache=None):
+    """Recognize the 5-digit counter in an in-memory grayscale ROI (see score_frame)."""
+    if template_bank is None:
+        template_bank = DigitTemplateBank(predefined_digits_directory)
+    return score_frame(input_image, template_bank, use_ssim, similarity_threshold, cache)[0]
+
+def slice_unchanged(digit_slice, reference, change_threshold=SLICE_CHANGE_THRESHOLD):
+    """Whether the slice is within change_threshold of the reference, relative to its contrast.
+
+    The mean absolute difference is measured against the standard deviation of the reference
+    (at least one gray level), so a faint overlay is held to a tighter bound than a crisp one.
+    """
+    if digit_slice.shape != reference.shape:
+        return False
+    contrast = max(cv2.meanStdDev(reference)[1][0, 0], 1.0)
+    return cv2.absdiff(digit_slice, reference).mean() <= change_threshold * contrast
+
+class IncrementalRecognizer:
+    """Recognizes consecutive ROIs of one video, re-scoring only the digit slices that changed.
+
+    Each slice is compared with the slice at the same position that was last scored. If it is
+    unchanged by slice_unchanged with change_threshold the earlier DigitMatch is reused,
+    otherwise the slice is scored again. Every position is tested independently, so dropped
+    frames and several digits rolling over at once are handled like any other change.
+    """
+
+    def __init__(self, template_bank, use_ssim=True, similarity_threshold=0.8, change_threshold=SLICE_CHANGE_THRESHOLD, cache=None):
+        self.template_bank = template_bank
+        self.use_ssim = use_ssim
+        self.similarity_threshold = similarity_threshold
+        self.change_threshold = change_threshold
+        self.cache = cache
+        self.reused = 0
+        self.scored = 0
+        self._reference_slices = None
+        self._reference_results = None
+
+    def recognize(self, input_image):
+        """Return (number, confidence, margin) for the ROI, as score_frame does."""
+        return self.recognize_all([input_image])[0]
+
+    def recognize_all(self, input_images):
+        """Return (number, confidence, margin) for each of consecutive ROIs, as recognize does.
+
+        Whether a slice changed does not depend on how it scores, so the changed slices of all
+        the ROIs are found first and then scored together in one score_digit_slices pass.
+        """
+        num_slices = 5
+        if self._reference_slices is None:
+            self._reference_slices = [None] * num_slices
+            self._reference_results = [None] * num_slices
+
+        # Every position points into matches: first the matches kept from earlier calls, then
+        # those of the changed slices, numbered in the order they are scored
+        matches = list(self._reference_results)
+        slots = list(range(num_slices))
+        changed = []
+        frame_slots = []
+        for input_image in input_images:
+            for i, digit_slice in enumerate(slice_image(input_image, num_slices)):
+                if self._reference_slices[i] is None or not slice_unchanged(digit_slice, self._reference_slices[i], self.change_threshold):
+                    self._reference_slices[i] = digit_slice.copy()
+                    slots[i] = len(matches) + len(changed)
+                    changed.append(digit_slice)
+            frame_slots.append(list(slots))
+        matches += score_digit_slices(changed, self.template_bank, self.use_ssim, cache=self.cache)
+        self._reference_results = [matches[slot] for slot in slots]
+
+        self.scored += len(changed)
+        self.reused += num_slices * len(input_images) - len(changed)
+        results = []
+        for slots in frame_slots:
+            scored_slices = [matches[slot] for slot in slots]
+            results.append((combine_digits(scored_slices, self.use_ssim, self.similarity_threshold),
+                            weakest_score(scored_slices, self.use_ssim), weakest_margin(scored_slices)))
+        return results
+
+def process_image(input_image_path, predefined_digits_directory, use_ssim=True, template_bank=None):
+    input_image = cv2.imread(input_image_path, cv2.IMREAD_GRAYSCALE)
+    return process_frame(input_image, predefined_digits_directory, use_ssim, template_bank=template_bank)
+
+def frame_sort_key(filename):
+    """Order frame_<index>.png files by their frame index rather than alphabetically."""
+    digits = ''.join(ch for ch in filename if ch.isdigit())
+    return (int(digits) if digits else -1, filename)
+
+def iter_images_in_directory(directory):
+    """Yield (filename, grayscale image) for every frame image saved in the directory, in frame order."""
+    for filename in sorted(os.listdir(directory), key=frame_sort_key):
+        if filename.endswith('.png') or filename.endswith('.jpg'):
+            image_path = os.path.join(directory, filename)
+            yield filename, cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+
+class PredictiveRecognizer:
+    """Recognizes consecutive ROIs by first testing the counter values expected next.
+
+    Once a frame has been read, the glyph seen at every digit position is remembered for its
+    digit value. A candidate number (the previous number + 1 up to + window, wrapping at the
+    counter width) is accepted when every slice of the ROI is unchanged from the remembered glyph
+    of its digit by slice_unchanged with change_threshold. Observed glyphs tell digits apart
+    far better than template SSIM, so one cheap comparison per slice decides the common case.
+    Frames that match no candidate go through the fallback recognizer, which is also how the
+    glyphs are learned. A predicted frame gets the lowest confidence and margin its glyphs were
+    learned with.
+    """
+
+    def __init__(self, fallback, window=PREDICTION_WINDOW, change_threshold=SLICE_CHANGE_THRESHOLD, num_slices=5):
+        self.fallback = fallback
+        self.window = window
+        self.change_threshold = change_threshold
+        self.num_slices = num_slices
+        self.predicted = 0
+        self.fallbacks = 0
+        self._last_number = None
+        self._glyphs = {}
+
+    def _matches(self, digit_slices, digits):
+        for position, (digit_slice, digit) in enumerate(zip(digit_slices, digits)):
+            glyph = self._glyphs.get((position, digit), (None,))[0]
+            if glyph is None or not slice_unchanged(digit_slice, glyph, self.change_threshold):
+                return False
+        return True
+
+    def recognize(self, input_image):
+        """Return (number, confidence, margin) for the ROI, as score_frame does."""
+        digit_slices = slice_image(input_image, self.num_slices)
+        if self._last_number is not None:
+            for step in range(1, self.window + 1):
+                digits = f'{(self._last_number + step) % 10 ** self.num_slices:0{self.num_slices}d}'
+                if self._matches(digit_slices, digits):
+                    self.predicted += 1
+                    self._last_number = int(digits)
+                    glyphs = [self._glyphs[(position, digit)] for position, digit in enumerate(digits)]
+                    return digits, min(glyph[1] for glyph in glyphs), min(glyph[2] for glyph in glyphs)
+
+        self.fallbacks += 1
+        final_number, confidence, margin = self.fallback(input_image)
+        if final_number is not None and len(final_number) == len(digit_slices):
+            for position, (digit_slice, digit) in enumerate(zip(digit_slices, final_number)):
+                self._glyphs[(position, digit)] = (digit_slice.copy(), confidence, margin)
+            self._last_number = int(final_number)
+        return final_number, confidence, margin
+
+def load_recognizer(options, template_bank=None):
+    """Return the recognizer of the RecognitionOptions (or DetectionOptions) and the options to use it with.
+
+    That is the DigitClassifier saved at options.model_path, whose confidence stands in for
+    the SSIM score, so use_ssim is turned on; otherwise it is template_bank, or the templates
+    of options.predefined_dir when none is given.
+    """
+    if options.model_path is None:
+        return (template_bank if template_bank is not None else DigitTemplateBank(options.predefined_dir)), options
+    from classifier import DigitClassifier
+    return DigitClassifier.load(options.model_path), options._replace(use_ssim=True)
+
+def frame_recognizer(template_bank, use_ssim=True, cache=None, incremental=False, predictive=False):
+    """Return a function recognizing the counter of one grayscale ROI after another, as (number, confidence, margin).
+
+    incremental and predictive pick IncrementalRecognizer and PredictiveRecognizer; both keep
+    state between calls, so the frames must be passed in order.
+    """
+    if incremental:
+        recognize = IncrementalRecognizer(template_bank, use_ssim, cache=cache).recognize
     else:
-        # Process all images in directory
-        for filename in os.listdir(directory):
-            if filename.endswith('.png') or filename.endswith('.jpg'):
-                image_path = os.path.join(directory, filename)
-                final_number = process_image(image_path, predefined_digits_dir, use_ssim)
-                
+        recognize = lambda image: score_frame(image, template_bank, use_ssim, cache=cache)
+    if predictive:
+        recognize = PredictiveRecognizer(recognize).recognize
+    return recognize
+
+def recognize_frames(frames, options=RecognitionOptions(), template_bank=None, cancel_check=None, cache=None, metrics=None,
+                     with_confidence=False):
+    """Yield (frame_index, detected_number) for each (frame_index, grayscale ROI) in frames, until cancel_check() returns True.
+
+    detected_number is None when the counter could not be read in that frame. With
+    with_confidence, the weakest_score and weakest_margin of the frame's digits follow it.
+    ProcessingMetrics count and time every frame (see count_recognized).
+    """
+    use_ssim = options.use_ssim
+    if template_bank is None:
+        template_bank = DigitTemplateBank(options.predefined_dir)
+
+    recognize = frame_recognizer(template_bank, use_ssim, cache=cache, incremental=options.incremental, predictive=options.predictive)
+
+    for frame_index, image in frames:
+        if cancel_check is not None and cancel_check():
+            return
+        start = time.perf_counter()
+        final_number, confidence, margin = recognize(image)
+        if metrics is not None:
+            metrics.observe('recognize', time.perf_counter() - start)
+            count_recognized(metrics, [(final_number, margin)], use_ssim)
+        if final_number is None:
+            log(f"Number not found in image: {frame_index}")
+        elif is_borderline(final_number, margin, use_ssim):
+            log(f"Borderline read in image {frame_index}: {final_number} (margin: {margin})")
+        yield (frame_index, final_number, confidence, margin) if with_confidence else (frame_index, final_number)
+
+def count_recognized(metrics, results, use_ssim=True):
+    """Count the (number, margin) results of recognized frames, the unreadable and the borderline ones."""
+    metrics.count('frames_recognized', len(results))
+    metrics.count('frames_unreadable', sum(1 for number, _ in results if number is None))
+    metrics.count('frames_borderline', sum(1 for number, margin in results if is_borderline(number, margin, use_ssim)))
+
+# Template bank and recognition cache of a worker process, set up once by its initializer
+_worker_template_bank = None
+_worker_cache = None
+
+def _init_recognition_worker(predefined_digits_dir, cache_size, verbose=False, model_path=None):
+    global _worker_template_bank, _worker_cache
+    set_verbose(verbose)
+    _worker_template_bank, _ = load_recognizer(RecognitionOptions(predefined_digits_dir, model_path=model_path))
+    _worker_cache = RecognitionCache(cache_size) if cache_size else None
+
+def _recognize_chunk(chunk, use_ssim, incremental, predictive):
+    hits, misses = (_worker_cache.hits, _worker_cache.misses) if _worker_cache is not None else (0, 0)
+    # Chunks are consecutive frames, so stateful recognizers start afresh at each chunk. The
+    # slices of the whole chunk are scored in one batch, except with prediction, where what is
+    # scored depends on the frames read before
+    images = [image for _, image in chunk]
+    start = time.perf_counter()
+    if predictive:
+        recognize = frame_recognizer(_worker_template_bank, use_ssim, cache=_worker_cache, incremental=incremental, predictive=True)
+        recognized = [recognize(image) for image in images]
+    elif incremental:
+        recognized = IncrementalRecognizer(_worker_template_bank, use_ssim, cache=_worker_cache).recognize_all(images)
+    else:
+        recognized = score_frames(images, _worker_template_bank, use_ssim, cache=_worker_cache)
+    results = [(frame_index,) + tuple(result) for (frame_index, _), result in zip(chunk, recognized)]
+    elapsed = time.perf_counter() - start
+    if _worker_cache is not None:
+        hits, misses = _worker_cache.hits - hits, _worker_cache.misses - misses
+    return results, hits, misses, elapsed
+
+def recognize_frames_parallel(frames, options=RecognitionOptions(), cancel_check=None, cache=None, metrics=None, with_confidence=False,
+                              chunk_size=RECOGNITION_CHUNK_SIZE):
+    """Like recognize_frames, but shards chunks of frames across options.workers processes.
+
+    Results are yielded in frame order. Once cancel_check() returns True the queued chunks are
+    cancelled and the generator stops. Every worker keeps a cache of the size of the given one,
+    and each chunk gets its own stateful recognizers.
+    """
+    use_ssim, incremental, predictive = options.use_ssim, options.incremental, options.predictive
+    workers = options.workers or os.cpu_count() or 1
+    frames = iter(frames)
+    cache_size = cache.max_size if cache is not None else 0
+    # Spawned rather than forked: the caller may already run a decoder thread, and forking a
+    # process that has other threads running can deadlock the children
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_recognition_worker, initargs=(options.predefined_dir, cache_size, is_verbose(), options.model_path))
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(itertools.islice(frames, chunk_size))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_recognize_chunk, chunk, use_ssim, incremental, predictive))
+            if not pending:
+                return
+
+            future = pending.popleft()
+            while not wait([future], timeout=0.1).done:
+                if cancel_check is not None and cancel_check():
+                    return
+            if cancel_check is not None and cancel_check():
+                return
+
+            results, hits, misses, elapsed = future.result()
+            if cache is not None:
+                cache.hits += hits
+                cache.misses += misses
+            if metrics is not None and results:
+                metrics.observe('recognize', elapsed / len(results), len(results))
+                count_recognized(metrics, [(final_number, margin) for _, final_number, _, margin in results], use_ssim)
+            for frame_index, final_number, confidence, margin in results:
                 if final_number is None:
-                    print(f"Number not found in image: {filename}")
-                    continue  # Skip this image if number not found
+                    log(f"Number not found in image: {frame_index}")
+                elif is_borderline(final_number, margin, use_ssim):
+                    log(f"Borderline read in image {frame_index}: {final_number} (margin: {margin})")
+                yield (frame_index, final_number, confidence, margin) if with_confidence else (frame_index, final_number)
+    finally:
+        # Join the workers when done, so the caller never exits with children still alive;
+        # on cancel (or an abandoned generator) do not wait for the chunks still in flight
+        executor.shutdown(wait=not pending, cancel_futures=True)
 
-                final_outputs[filename] = final_number
+def process_all_images_in_directory(directory, predefined_digits_dir, use_ssim=True,check_valid_digits_in_frame=False, template_bank=None, workers=None, cancel_check=None):
+    """Recognize the saved frames in frame order and return the missing counter values as (start, end) ranges."""
 
-        # Detect missing frames
-        frames_found = [int(detected_number) for detected_number in final_outputs.values()]
-        frames_found.sort()
+    # Load the digit templates once for every frame in the directory
+    if template_bank is None:
+        template_bank = DigitTemplateBank(predefined_digits_dir)
 
-        val = frames_found[0]
-        for i in frames_found[1:]:
-            if i - val > 1:
-                for j in range(1, i - val):
-                    missing_frames.append(val + j)
-            val = i
-        print(missing_frames)
-        return missing_frames
+    frames = iter_images_in_directory(directory)
+    options = RecognitionOptions(predefined_digits_dir, use_ssim, workers=workers)
+
+    if check_valid_digits_in_frame:
+        for filename, final_number in recognize_frames(frames, options, template_bank=template_bank):
+            return final_number is not None
+    else:
+        # Process all images in directory, sharded across worker processes when requested
+        if workers is not None and workers > 1:
+            results = recognize_frames_parallel(frames, options, cancel_check=cancel_check)
+        else:
+            results = recognize_frames(frames, options, template_bank=template_bank, cancel_check=cancel_check)
+
+        # Detect missing frames as the numbers come in
+        gap_detector = GapDetector()
+        for filename, final_number in results:
+            if final_number is None:
+                continue  # Skip this image if number not found
+
+            gap_detector.add(int(final_number))
+
+        missing_ranges = gap_detector.finish()
+        log(missing_ranges)
+        return missing_ranges
 
 
 if __name__ == "__main__":
+    from extract import extract_frames
+
     s = time.time()
     
     extracted_images_dir = 'extracted_frames'  
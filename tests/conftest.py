@@ -0,0 +1,25 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+from benchmark import render_counter_video
+from ssim import DigitTemplateBank
+
+PREDEFINED_DIR = os.path.join(ROOT, 'uploads', 'predefined_digits')
+
+# Counter values dropped from the rendered video: single frames, a run, and both sides of the rollover
+COUNTER_DROPS = (99950, 99999, 100000, 100030, 100031)
+
+@pytest.fixture(scope='session')
+def template_bank():
+    return DigitTemplateBank(PREDEFINED_DIR)
+
+@pytest.fixture(scope='session')
+def counter_video(tmp_path_factory):
+    """Path of a 200-frame video whose counter runs from 99900 over the rollover, minus COUNTER_DROPS."""
+    path = str(tmp_path_factory.mktemp('videos') / 'counter.mp4')
+    render_counter_video(path, 200, COUNTER_DROPS, start=99900, predefined_dir=PREDEFINED_DIR)
+    return path
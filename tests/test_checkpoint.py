@@ -0,0 +1,63 @@
+import os
+import numpy as np
+from array import array
+from conftest import PREDEFINED_DIR
+from checkpoint import CHECKPOINT_RECORD, Checkpoint, video_identity, checkpoint_path, save_checkpoint, load_checkpoint, remove_checkpoint
+from extract import DetectionOptions, detect_missing_frames
+
+def progress(video_path, frames, region=(10, 20, 30, 40)):
+    numbers = array('i', range(100, 100 + frames))
+    confidences = array('f', [0.5] * frames)
+    timestamps = array('d', [index / 30 for index in range(frames)])
+    margins = array('f', [0.25] * frames)
+    return Checkpoint(video_identity(video_path), frames, numbers, 1, region, confidences, timestamps, margins)
+
+def assert_loaded(loaded, checkpoint):
+    assert (loaded.identity, loaded.next_frame, loaded.rotate_cnt, loaded.region) == checkpoint[:2] + checkpoint[3:5]
+    assert loaded.numbers.tolist() == checkpoint.numbers[:checkpoint.next_frame].tolist()
+    assert np.array_equal(loaded.timestamps, np.frombuffer(checkpoint.timestamps)[:checkpoint.next_frame])
+    assert np.allclose(loaded.confidences, 0.5) and np.allclose(loaded.margins, 0.25)
+
+def test_round_trip_and_appended_tail(tmp_path):
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'video')
+    save_checkpoint(str(video), progress(video, 10), str(tmp_path))
+    save_checkpoint(str(video), progress(video, 25), str(tmp_path))
+    assert_loaded(load_checkpoint(str(video), str(tmp_path)), progress(video, 25))
+    assert os.path.getsize(checkpoint_path(str(video), str(tmp_path)) + '.frames') == 25 * CHECKPOINT_RECORD.itemsize
+
+def test_torn_record_is_ignored_and_written_over(tmp_path):
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'video')
+    save_checkpoint(str(video), progress(video, 10), str(tmp_path))
+    with open(checkpoint_path(str(video), str(tmp_path)) + '.frames', 'ab') as f:
+        f.write(b'\xff' * (CHECKPOINT_RECORD.itemsize // 2))
+    assert load_checkpoint(str(video), str(tmp_path)).next_frame == 10
+    save_checkpoint(str(video), progress(video, 12), str(tmp_path))
+    assert_loaded(load_checkpoint(str(video), str(tmp_path)), progress(video, 12))
+
+def test_new_location_drops_the_saved_frames(tmp_path):
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'video')
+    save_checkpoint(str(video), progress(video, 10), str(tmp_path))
+    save_checkpoint(str(video), progress(video, 4, region=(0, 0, 30, 40)), str(tmp_path))
+    assert_loaded(load_checkpoint(str(video), str(tmp_path)), progress(video, 4, region=(0, 0, 30, 40)))
+
+def test_modified_video_and_removal(tmp_path):
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(b'video')
+    save_checkpoint(str(video), progress(video, 10), str(tmp_path))
+    stat = os.stat(video)
+    os.utime(video, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert load_checkpoint(str(video), str(tmp_path)) is None
+    remove_checkpoint(str(video), str(tmp_path))
+    assert os.listdir(tmp_path) == ['video.mp4']
+
+def test_cancelled_detection_resumes(counter_video, tmp_path):
+    options = DetectionOptions(predefined_dir=PREDEFINED_DIR, profiles_path=None, checkpoint_dir=str(tmp_path))
+    expected = detect_missing_frames(counter_video, options._replace(checkpoint_dir=None))
+    checks = iter(range(10**6))
+    frame_count, _ = detect_missing_frames(counter_video, options, cancel_check=lambda: next(checks) >= 60)
+    assert 0 < load_checkpoint(counter_video, str(tmp_path)).next_frame == frame_count < 200
+    assert detect_missing_frames(counter_video, options) == expected
+    assert load_checkpoint(counter_video, str(tmp_path)) is None
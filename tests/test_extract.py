@@ -0,0 +1,47 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from conftest import PREDEFINED_DIR, COUNTER_DROPS
+from benchmark import render_counter_video
+from gaps import COUNTER_MODULUS, missing_ranges_between
+from extract import (ROTATE_CODES, DetectionOptions, crop_frame, crop_rotated_roi, rotated_region, orientation_confidence,
+                     detect_missing_frames, detect_missing_frames_sparse)
+from ffmpeg_decode import ffmpeg_roi_filters
+
+OPTIONS = DetectionOptions(predefined_dir=PREDEFINED_DIR, profiles_path=None)
+
+def expected_ranges(drops):
+    return missing_ranges_between([(value, value) for value in sorted(set(range(min(drops) - 1, max(drops) + 2)) - set(drops))], COUNTER_MODULUS)
+
+@pytest.mark.parametrize('rotate_cnt', range(4))
+@pytest.mark.parametrize('region', [(30, 20, 50, 10), (45, 40, 40, 30), (-5, 10, 40, 20)])
+def test_rotated_region_crops_like_the_rotated_frame(rotate_cnt, region):
+    frame = np.random.default_rng(0).integers(0, 256, (60, 100, 3), dtype=np.uint8)
+    rotated = cv2.rotate(frame, ROTATE_CODES[rotate_cnt]) if rotate_cnt else frame
+    x, y, w, h = region
+    expected = crop_frame(cv2.cvtColor(rotated, cv2.COLOR_BGR2GRAY), (max(x, 0), max(y, 0), w + min(x, 0), h + min(y, 0)))
+    assert np.array_equal(crop_rotated_roi(frame, region, rotate_cnt), expected)
+
+def test_orientation_confidence_of_a_region_outside_the_frame(template_bank):
+    frame = np.zeros((180, 320, 3), dtype=np.uint8)
+    for rotate_cnt in range(4):
+        assert orientation_confidence(frame, template_bank, (200, 200, 250, 50), rotate_cnt) == -1
+
+def test_detection_across_the_rollover(counter_video):
+    assert expected_ranges(COUNTER_DROPS) == [(99950, 99950), (99999, 99999), (0, 0), (30, 31)]
+    assert detect_missing_frames(counter_video, OPTIONS) == (200, expected_ranges(COUNTER_DROPS))
+
+@pytest.mark.parametrize('stride', [1, 7, 32])
+def test_sparse_scan_matches_the_full_scan(counter_video, stride):
+    assert detect_missing_frames_sparse(counter_video, OPTIONS._replace(sparse_stride=stride)) == detect_missing_frames(counter_video, OPTIONS)
+
+def test_counter_is_found_in_low_resolution_video(tmp_path):
+    path = str(tmp_path / 'low.mp4')
+    drops = (130, 131, 170)
+    render_counter_video(path, 100, drops, start=100, resolution=(320, 180), rotation=90, predefined_dir=PREDEFINED_DIR, region=(10, 10, 100, 20))
+    assert detect_missing_frames(path, OPTIONS) == (100, expected_ranges(drops))
+
+def test_ffmpeg_crops_gray_frames_exactly():
+    filters = ffmpeg_roi_filters((201, 203, 251, 47), 1, start_frame=5).split(',')
+    assert filters == ['trim=start_frame=5', 'format=gray', 'crop=251:47:201:203:exact=1', 'transpose=2']
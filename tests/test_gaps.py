@@ -0,0 +1,59 @@
+from gaps import GapDetector, counter_ranges, missing_ranges, missing_ranges_between, range_count, format_ranges
+
+def test_missing_ranges_in_order():
+    assert missing_ranges([1, 2, 3, 6, 7, 10]) == [(4, 5), (8, 9)]
+
+def test_rollover_is_not_a_gap():
+    assert missing_ranges([99998, 99999, 0, 1]) == []
+
+def test_gap_across_the_rollover_is_split():
+    assert missing_ranges([99997, 99999, 1, 2]) == [(99998, 99998), (0, 0)]
+    assert missing_ranges([99990, 5]) == [(99991, 99999), (0, 4)]
+
+def test_reordered_numbers_are_put_in_place():
+    detector = GapDetector()
+    for number in [1, 2, 4, 3, 5]:
+        detector.add(number)
+    assert detector.finish() == []
+    assert detector.stats()['reordered'] == 1
+
+def test_numbers_later_than_the_window_are_counted_late():
+    detector = GapDetector(window=2)
+    for number in [1, 2, 5, 6, 7, 3]:
+        detector.add(number)
+    assert detector.finish() == [(3, 4)]
+    assert detector.stats()['late'] == 1
+
+def test_duplicates_are_counted():
+    detector = GapDetector()
+    for number in [1, 2, 2, 3]:
+        detector.add(number)
+    assert detector.finish() == []
+    assert detector.stats()['duplicates'] == 1
+
+def test_gaps_are_reported_as_soon_as_known():
+    reported = []
+    detector = GapDetector(window=1, on_gap=lambda start, end: reported.append((start, end)))
+    for number in [1, 4, 5]:
+        detector.add(number)
+    assert reported == [(2, 3)]
+
+def test_stats_count_wraps():
+    detector = GapDetector()
+    for number in [99999, 0, 1]:
+        detector.add(number)
+    detector.finish()
+    assert detector.stats()['wraps'] == 1
+
+def test_counter_ranges():
+    assert list(counter_ranges(5, 9)) == [(5, 9)]
+    assert list(counter_ranges(99998, 100001)) == [(99998, 99999), (0, 1)]
+
+def test_missing_ranges_between_unwrapped_intervals():
+    assert missing_ranges_between([(100002, 100005), (99990, 99995)]) == [(99996, 99999), (0, 1)]
+    assert missing_ranges_between([(1, 10), (5, 12), (14, 20)]) == [(13, 13)]
+
+def test_range_helpers():
+    ranges = [(110, 111), (130, 130)]
+    assert range_count(ranges) == 3
+    assert format_ranges(ranges) == '110-111, 130'
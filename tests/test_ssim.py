@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+import pytest
+from classifier import slice_features, area_matrix
+from ssim import (BORDERLINE_MARGIN, SLICE_CHANGE_THRESHOLD, IncrementalRecognizer, batch_ssim, score_frame, score_frames,
+                  slice_image, slice_unchanged)
+
+SLICE_SHAPE = (50, 50)
+
+def counter_roi(template_bank, number, contrast=1.0, noise=0.0, seed=0):
+    """ROI of the 5-digit counter drawn from the templates, blended into mid gray at the contrast."""
+    stack = template_bank.stacked(SLICE_SHAPE)
+    glyphs = {str(digit): image for digit, image in zip(stack.digits, stack.images)}
+    roi = np.hstack([glyphs[digit] for digit in f'{number:05d}']).astype(np.float64) * contrast + 128 * (1 - contrast)
+    roi += np.random.default_rng(seed).normal(0, noise, roi.shape)
+    return np.clip(roi, 0, 255).astype(np.uint8)
+
+def test_batch_ssim_matches_skimage(template_bank):
+    structural_similarity = pytest.importorskip('skimage.metrics').structural_similarity
+    stack = template_bank.stacked(SLICE_SHAPE)
+    rng = np.random.default_rng(0)
+    slices = np.clip(stack.images[rng.integers(0, 10, 4)] + rng.normal(0, 20, (4,) + SLICE_SHAPE), 0, 255).astype(np.uint8)
+    scores = batch_ssim(slices, stack)
+    for i, digit_slice in enumerate(slices):
+        for j, template in enumerate(stack.images):
+            expected = structural_similarity(digit_slice.astype(np.float64), template.astype(np.float64), data_range=255)
+            assert scores[i, j] == pytest.approx(expected, abs=1e-9)
+
+def test_cascade_picks_the_digit_of_full_ssim(template_bank):
+    stack = template_bank.stacked(SLICE_SHAPE)
+    rng = np.random.default_rng(1)
+    slices = []
+    for _ in range(300):
+        first, second = rng.integers(0, 10, 2)
+        blend = rng.uniform(0.3, 1.0)
+        image = stack.images[first] * blend + stack.images[second] * (1 - blend) + rng.normal(0, 3, SLICE_SHAPE)
+        slices.append(np.clip(image, 0, 255).astype(np.uint8))
+    slices = np.stack(slices)
+
+    full = batch_ssim(slices, stack)
+    full_margins = np.diff(np.sort(full, axis=1)[:, -2:], axis=1)[:, 0]
+    digits, scores, margins = template_bank.score_batch(slices)
+    assert digits == [int(stack.digits[i]) for i in full.argmax(axis=1)]
+    assert scores == pytest.approx(full.max(axis=1))
+    # Cascade margins are upper bounds, but never hide a borderline digit
+    assert np.all(margins >= full_margins - 1e-12)
+    assert not np.any((full_margins < BORDERLINE_MARGIN) & (margins >= BORDERLINE_MARGIN))
+
+def test_score_frames_matches_score_frame(template_bank):
+    rois = [counter_roi(template_bank, number, noise=2, seed=number) for number in range(100, 120)]
+    assert score_frames(rois, template_bank) == [score_frame(roi, template_bank) for roi in rois]
+    assert score_frame(rois[0], template_bank)[0] == '00100'
+
+def test_incremental_batch_matches_one_frame_at_a_time(template_bank):
+    rois = [counter_roi(template_bank, number, noise=1, seed=number) for number in range(95, 130)]
+    one_at_a_time = IncrementalRecognizer(template_bank)
+    expected = [one_at_a_time.recognize(roi) for roi in rois]
+    batched = IncrementalRecognizer(template_bank)
+    assert batched.recognize_all(rois[:10]) + batched.recognize_all(rois[10:]) == expected
+    assert (batched.scored, batched.reused) == (one_at_a_time.scored, one_at_a_time.reused)
+    assert [number for number, _, _ in expected] == [f'{number:05d}' for number in range(95, 130)]
+
+@pytest.mark.parametrize('contrast', [1.0, 0.25])
+def test_closest_glyphs_count_as_changed_at_any_contrast(template_bank, contrast):
+    eight, nine = (slice_image(counter_roi(template_bank, number, contrast), 5)[4] for number in (8, 9))
+    assert not slice_unchanged(nine, eight)
+    noisy = slice_image(counter_roi(template_bank, 8, contrast, noise=0.5, seed=1), 5)[4]
+    assert slice_unchanged(noisy, eight, SLICE_CHANGE_THRESHOLD)
+
+def test_slice_features_match_inter_area():
+    batch = np.random.default_rng(2).integers(0, 256, (6, 47, 31), dtype=np.uint8)
+    resized = np.stack([cv2.resize(image, (16, 16), interpolation=cv2.INTER_AREA) for image in batch]).astype(np.float32)
+    averaged = area_matrix(47, 16) @ batch.astype(np.float32) @ area_matrix(31, 16).T
+    assert np.abs(averaged - resized).max() <= 0.5 + 1e-4
+    assert slice_features(batch).shape == (6, 256)